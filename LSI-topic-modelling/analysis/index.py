@@ -0,0 +1,390 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def top_k(scores: np.ndarray, top_n: int = None) -> tuple:
+    """
+    Selects the highest scores with a partial sort, instead of sorting every score.
+
+    Params:
+        scores: An array of scores, one per document. A 2-d array is handled row by row.
+        top_n: Number of wanted results. All scores are returned, if None.
+
+    Returns a tuple of arrays (document-numbers, document-similarities), sorted by descending similarity
+    """
+    num_documents = scores.shape[-1]
+
+    if top_n is None or top_n >= num_documents:
+        ids = np.argsort(-scores, axis=-1, kind="stable")
+    elif top_n <= 0:
+        ids = np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    else:
+        ids = np.argpartition(-scores, top_n - 1, axis=-1)[..., :top_n]
+        # Only the selected scores need sorting
+        order = np.argsort(-np.take_along_axis(scores, ids, axis=-1), axis=-1, kind="stable")
+        ids = np.take_along_axis(ids, order, axis=-1)
+
+    return ids, np.take_along_axis(scores, ids, axis=-1)
+
+
+class ShardedIndex:
+    """
+    Document index of unit-length LSI-vectors, stored in a directory as shards of at most 'shard_size' documents.
+
+    Shards are memory-mapped read-only, so processes using the same index share its pages instead of each holding a copy.
+    Shards are queried in parallel, in a thread pool shared by every index of the process.
+    """
+    META_FILENAME = "index.json"
+
+    _executor = None
+
+    def __init__(self, directory: str, num_features: int, shard_size: int, shard_rows: list = None, workers: int = None) -> None:
+        """
+        Params:
+            * directory: Directory of the shard-files
+            * num_features: Length of the vectors, i.e. the number of LSI-topics
+            * shard_size: Maximum number of documents per shard
+            * shard_rows: Number of documents in each existing shard
+            * workers: Size of the thread pool for querying shards, when the pool is first needed
+        """
+        self.directory = directory
+        self.num_features = num_features
+        self.shard_size = shard_size
+        self.shard_rows = shard_rows or []
+        self.workers = workers
+        self.shards = [self._map_shard(i) for i in range(len(self.shard_rows))]
+
+
+    @classmethod
+    def build(cls, directory: str, chunks, num_features: int, shard_size: int, workers: int = None) -> "ShardedIndex":
+        """
+        Writes a new index from an iterable of vector-arrays, without holding more than one shard in memory.
+        Replaces a previous index in the directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+
+        index = cls(directory, num_features, shard_size, workers=workers)
+        index.append(chunks)
+        return index
+
+
+    @classmethod
+    def load(cls, directory: str, workers: int = None) -> "ShardedIndex":
+        """
+        Maps the shards of an index written earlier. Raises FileNotFoundError, if there is none in the directory.
+        """
+        with open(os.path.join(directory, cls.META_FILENAME)) as f:
+            meta = json.load(f)
+
+        return cls(directory, meta["num_features"], meta["shard_size"], meta["shard_rows"], workers)
+
+
+    def __len__(self) -> int:
+        return sum(self.shard_rows)
+
+
+    def _shard_filename(self, shard: int) -> str:
+        return os.path.join(self.directory, f"shard-{shard:05d}.npy")
+
+
+    def _map_shard(self, shard: int) -> np.ndarray:
+        return np.load(self._shard_filename(shard), mmap_mode="r")
+
+
+    def _write_shard(self, shard: int, vectors: np.ndarray) -> None:
+        # Written beside the shard and swapped in, processes still mapping the old file keep reading it
+        filename = self._shard_filename(shard)
+        with open(filename + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        os.replace(filename + ".tmp", filename)
+
+        if shard < len(self.shards):
+            self.shards[shard] = self._map_shard(shard)
+        else:
+            self.shards.append(self._map_shard(shard))
+
+
+    def _save_meta(self) -> None:
+        meta = {"num_features": self.num_features, "shard_size": self.shard_size, "shard_rows": self.shard_rows}
+
+        filename = os.path.join(self.directory, self.META_FILENAME)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(filename + ".tmp", filename)
+
+
+    def append(self, chunks) -> None:
+        """
+        Adds vectors to the end of the index. Only the last shard is rewritten, if it still has room.
+
+        Params:
+            chunks: An array of vectors, or an iterable of such arrays
+        """
+        if isinstance(chunks, np.ndarray):
+            chunks = [chunks]
+
+        for vectors in chunks:
+            while len(vectors) > 0:
+                if self.shard_rows and self.shard_rows[-1] < self.shard_size:
+                    shard = len(self.shard_rows) - 1
+                    room = self.shard_size - self.shard_rows[shard]
+                    shard_vectors = np.vstack([self.shards[shard], vectors[:room]])
+                else:
+                    shard = len(self.shard_rows)
+                    room = self.shard_size
+                    shard_vectors = vectors[:room]
+                    self.shard_rows.append(0)
+
+                self._write_shard(shard, shard_vectors)
+                self.shard_rows[shard] = len(shard_vectors)
+                vectors = vectors[room:]
+
+        self._save_meta()
+
+
+    def _map(self, func) -> list:
+        # Runs func(shard, offset) for every shard in the thread pool; numpy releases the GIL for the products
+        offsets = np.cumsum([0] + self.shard_rows[:-1])
+        if len(self.shards) < 2:
+            return [func(shard, offset) for shard, offset in zip(self.shards, offsets)]
+
+        if ShardedIndex._executor is None:
+            ShardedIndex._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        return list(ShardedIndex._executor.map(func, self.shards, offsets))
+
+
+    def similarities(self, vectors: np.ndarray, start: int = 0) -> np.ndarray:
+        """
+        Scores unit-length query-vectors against every document, or against the documents from document-number 'start' on.
+
+        Returns an array of document-similarities with one row per query, indexed by document-number minus 'start'
+        """
+        result = np.empty((len(vectors), len(self) - start), dtype=np.float32)
+
+        def score(shard, offset):
+            if offset + len(shard) <= start:
+                return
+            skip = max(start - offset, 0)
+            result[:, offset + skip - start:offset + len(shard) - start] = vectors @ shard[skip:].T
+
+        self._map(score)
+        return result
+
+
+    def query(self, vectors: np.ndarray, top_n: int = None) -> tuple:
+        """
+        Finds the top_n most similar documents for unit-length query-vectors, merging the top_n of every shard.
+
+        Returns a tuple of arrays (document-numbers, document-similarities) with one row per query, sorted by descending similarity
+        """
+        def shard_top_k(shard, offset):
+            ids, scores = top_k(vectors @ shard.T, top_n)
+            return ids + offset, scores
+
+        results = self._map(shard_top_k)
+        if not results:
+            return top_k(np.zeros((len(vectors), 0), dtype=np.float32), top_n)
+
+        ids = np.concatenate([shard_ids for shard_ids, _ in results], axis=-1)
+        scores = np.concatenate([shard_scores for _, shard_scores in results], axis=-1)
+
+        merged, scores = top_k(scores, top_n)
+        return np.take_along_axis(ids, merged, axis=-1), scores
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour search over a ShardedIndex, with an inverted file (IVF) of k-means clusters.
+
+    The vectors are clustered with spherical k-means and stored grouped by cluster, so a query only scores the documents of the
+    'num_probes' clusters closest to it. Documents appended to the ShardedIndex after the clusters were built are scored exactly,
+    until the next build.
+    """
+    META_FILENAME = "ivf.json"
+
+    def __init__(self, directory: str, index: ShardedIndex, num_probes: int) -> None:
+        """
+        Params:
+            * directory: Directory of the cluster-files
+            * index: The exact index of the same documents
+            * num_probes: Number of closest clusters scored per query
+        """
+        self.directory = directory
+        self.index = index
+        self.num_probes = num_probes
+
+        with open(os.path.join(directory, self.META_FILENAME)) as f:
+            self.meta = json.load(f)
+
+        self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+
+
+    @staticmethod
+    def _kmeans(sample: np.ndarray, num_lists: int, iterations: int, seed: int) -> np.ndarray:
+        # Spherical k-means: documents are assigned by cosine similarity, and centroids kept at unit length
+        rng = np.random.RandomState(seed)
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(num_lists):
+                members = sample[assignment == cluster]
+                if len(members) == 0:
+                    # Restart an empty cluster from a random document
+                    centroids[cluster] = sample[rng.randint(len(sample))]
+                    continue
+                centroid = members.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                centroids[cluster] = centroid / norm if norm > 0 else members[0]
+
+        return centroids
+
+
+    @classmethod
+    def build(cls, directory: str, index: ShardedIndex, num_lists: int = None, num_probes: int = 8,
+              training_sample: int = 100000, recall_sample: int = 1000, recall_k: int = 10, seed: int = 0) -> "IVFIndex":
+        """
+        Clusters the documents of an index and writes them grouped by cluster. Replaces a previous build in the directory.
+
+        Params:
+            * num_lists: Number of clusters, the square root of the number of documents if None
+            * training_sample: Number of documents the clusters are fitted on
+            * recall_sample, recall_k: Number of stored documents queried for measuring recall@k against exact search
+        """
+        num_documents = len(index)
+        rng = np.random.RandomState(seed)
+
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+
+        sample_ids = np.sort(rng.choice(num_documents, min(max(training_sample, 1), num_documents), replace=False))
+        sample = cls._gather(index, sample_ids)
+
+        # No more clusters than sampled documents, and none for an empty index
+        num_lists = min(num_lists or max(1, int(np.sqrt(num_documents))), len(sample))
+        if num_lists:
+            centroids = cls._kmeans(sample, num_lists, iterations=20, seed=seed)
+        else:
+            centroids = np.zeros((0, index.num_features), dtype=np.float32)
+
+        # Assign every document to its closest cluster, a shard at a time
+        assignment = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                    [np.argmax(shard @ centroids.T, axis=1) for shard in index.shards])
+        ids = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_lists))])
+
+        # Position of each document in the cluster-ordered vectors
+        positions = np.empty(num_documents, dtype=np.int64)
+        positions[ids] = np.arange(num_documents)
+
+        vectors = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"), mode="w+", dtype=np.float32,
+                                            shape=(num_documents, index.num_features))
+        offset = 0
+        for shard in index.shards:
+            vectors[positions[offset:offset + len(shard)]] = shard
+            offset += len(shard)
+        vectors.flush()
+        del vectors
+
+        np.save(os.path.join(directory, "centroids.npy"), centroids)
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+        np.save(os.path.join(directory, "ids.npy"), ids)
+        with open(os.path.join(directory, cls.META_FILENAME), "w") as f:
+            json.dump({"num_documents": num_documents, "num_lists": num_lists}, f)
+
+        ivf = cls(directory, index, num_probes)
+
+        query_ids = np.sort(rng.choice(num_documents, min(recall_sample, num_documents), replace=False))
+        ivf.meta["recall_at_k"] = ivf.recall_at_k(cls._gather(index, query_ids), recall_k)
+        ivf.meta["recall_k"] = recall_k
+        with open(os.path.join(directory, cls.META_FILENAME), "w") as f:
+            json.dump(ivf.meta, f)
+
+        return ivf
+
+
+    @staticmethod
+    def _gather(index: ShardedIndex, ids: np.ndarray) -> np.ndarray:
+        # Reads the vectors of sorted document-numbers from the shards
+        offsets = np.cumsum([0] + index.shard_rows)
+        return np.vstack([np.zeros((0, index.num_features), dtype=np.float32)] + [
+            index.shards[shard][ids[(ids >= start) & (ids < stop)] - start]
+            for shard, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:]))
+        ]).astype(np.float32)
+
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+    def _candidates(self, vector: np.ndarray) -> tuple:
+        # Document-numbers and scores of the documents in the closest clusters, and of the documents added after the build
+        clusters = top_k(self.centroids @ vector, self.num_probes)[0]
+        slices = [slice(self.offsets[c], self.offsets[c + 1]) for c in clusters]
+
+        ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [self.ids[s] for s in slices])
+        scores = np.concatenate([np.zeros(0, dtype=np.float32)] + [self.vectors[s] @ vector for s in slices])
+
+        num_built = self.meta["num_documents"]
+        if len(self.index) > num_built:
+            tail = self.index.similarities(vector[np.newaxis], start=num_built)[0]
+            ids = np.concatenate([ids, np.arange(num_built, len(self.index))])
+            scores = np.concatenate([scores, tail])
+
+        return ids, scores.astype(np.float32)
+
+
+    def similarities(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Scores unit-length query-vectors against the documents of their closest clusters. Other documents score zero.
+
+        Returns an array of document-similarities with one row per query, indexed by document-number
+        """
+        result = np.zeros((len(vectors), len(self)), dtype=np.float32)
+        for row, vector in enumerate(vectors):
+            ids, scores = self._candidates(vector)
+            result[row, ids] = scores
+
+        return result
+
+
+    def query(self, vectors: np.ndarray, top_n: int = None) -> tuple:
+        """
+        Finds approximately the top_n most similar documents for unit-length query-vectors.
+
+        Returns a tuple of arrays (document-numbers, document-similarities) with one row per query, sorted by descending similarity.
+        Rows are padded with document-number -1 and similarity 0, if the closest clusters hold fewer than top_n documents.
+        """
+        top_n = len(self) if top_n is None else min(top_n, len(self))
+        result_ids = np.full((len(vectors), top_n), -1, dtype=np.int64)
+        result_scores = np.zeros((len(vectors), top_n), dtype=np.float32)
+
+        for row, vector in enumerate(vectors):
+            ids, scores = self._candidates(vector)
+            selected, scores = top_k(scores, top_n)
+            result_ids[row, :len(selected)] = ids[selected]
+            result_scores[row, :len(selected)] = scores
+
+        return result_ids, result_scores
+
+
+    def recall_at_k(self, vectors: np.ndarray, k: int) -> float:
+        """
+        Share of the exact top-k documents that are also found by the approximate search, averaged over the query-vectors.
+        """
+        if len(vectors) == 0:
+            return 1.0
+
+        exact, _ = self.index.query(vectors, k)
+        approximate, _ = self.query(vectors, k)
+        found = [len(np.intersect1d(e, a)) for e, a in zip(exact, approximate)]
+        return float(np.sum(found) / exact.size)
@@ -1,12 +1,157 @@
-from gensim import similarities, corpora, models
-from gensim.test.utils import get_tmpfile
+from gensim import corpora, models, matutils, utils
 from nltk.stem import WordNetLemmatizer
 from nltk.stem.snowball import SnowballStemmer
 from nltk.corpus import stopwords
 
-from collections import defaultdict
+import os
+import json
+import uuid
+import fcntl
+import logging
+import shutil
+import threading
+import numpy as np
+from itertools import chain
+from multiprocessing import get_context
+from collections import Counter, defaultdict, deque, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 
+from analysis.index import ShardedIndex, IVFIndex
+
+
+logger = logging.getLogger(__name__)
+
+# Files of a version of an analyzer, in its version-directory
+DICTIONARY_FILENAME = "dictionary"
+LSI_MODEL_FILENAME = "lsi.model"
+CORPUS_FILENAME = "corpus.mm"
+INDEX_FILENAME = "index"
+ANN_FILENAME = "index.ivf"
+UPDATES_FILENAME = "updates.json"
+
+MANIFEST_FILENAME = "manifest.json"
+STAGING_PREFIX = ".staging-"
+
+# Saved by overwriting the file in place, so they are never hard-linked between versions
+_UNLINKED_FILENAMES = (DICTIONARY_FILENAME, LSI_MODEL_FILENAME, UPDATES_FILENAME)
+
+# Preprocessing resources per language, shared by every analyzer of the process
+_stoplists = {}
+_stemmers = {}
+_resources_lock = threading.Lock()
+
+
+def get_stoplist(language: str, custom_stopwords: tuple) -> frozenset:
+    """
+    Returns the stopwords of a language with the custom ones added. Built once per process and language.
+    """
+    key = (language, custom_stopwords)
+    with _resources_lock:
+        if key not in _stoplists:
+            _stoplists[key] = frozenset(stopwords.words(language)).union(custom_stopwords)
+        return _stoplists[key]
+
+
+def get_stemmer(language: str) -> tuple:
+    """
+    Returns the stemming function of a language (a WordNet lemmatizer for english, a Snowball stemmer otherwise),
+    and a cache of already stemmed words for it. Both are created once per process and language.
+    """
+    with _resources_lock:
+        if language not in _stemmers:
+            if language == "english":
+                stem = WordNetLemmatizer().lemmatize
+            else:
+                stem = SnowballStemmer(language).stem
+            # Loads the lazily loaded corpora now, while holding the lock
+            stem("test")
+            _stemmers[language] = (stem, {})
+        return _stemmers[language]
+
+
+def tokenize(document, stoplist: frozenset) -> list:
+    # Remove common words and tokenize
+    return [word for word in str(document).lower().split() if word not in stoplist and len(word) > 1]
+
+
+def stem_text(text: list, stem_word, stem_cache: dict, cache_size: int) -> list:
+    # Each distinct word is stemmed once, later occurrences are looked up from the cache
+    stems = []
+    for word in text:
+        stem = stem_cache.get(word)
+        if stem is None:
+            stem = stem_word(word)
+            # The cache stops growing at its maximum size, words after that are stemmed every time
+            if len(stem_cache) < cache_size:
+                stem_cache[word] = stem
+        stems.append(stem)
+    return stems
+
+
+def _preprocess_resources(language: str, custom_stopwords: tuple, cache_size: int, rare_words: frozenset) -> dict:
+    stem_word, stem_cache = get_stemmer(language)
+    return {
+        "stoplist": get_stoplist(language, custom_stopwords),
+        "stem_word": stem_word,
+        "stem_cache": stem_cache,
+        "cache_size": cache_size,
+        "rare_words": rare_words
+    }
+
+
+def _tokenize_chunk(task: tuple, resources: dict) -> Counter:
+    # Tokenizes a chunk of documents to a spill-file of its own, and counts the words in it
+    documents, spill_filename = task
+    frequency = Counter()
+    with open(spill_filename, "w") as f:
+        for document in documents:
+            if len(str(document)) > 1:
+                text = tokenize(document, resources["stoplist"])
+                frequency.update(text)
+                f.write(json.dumps(text) + "\n")
+    return frequency
+
+
+def _stem_chunk(spill_filename: str, resources: dict) -> str:
+    """
+    Removes the words that appear only once in the whole corpus from a spilled chunk, and stems the rest.
+
+    Returns the texts as lines of space-separated words, which pass between processes much faster than lists of words
+    """
+    with open(spill_filename) as f:
+        texts = [json.loads(line) for line in f]
+    os.remove(spill_filename)
+
+    rare_words = resources["rare_words"]
+    return "".join(
+        " ".join(stem_text([token for token in text if token not in rare_words],
+                           resources["stem_word"], resources["stem_cache"], resources["cache_size"])) + "\n"
+        for text in texts
+    )
+
+
+# Preprocessing workers are forked from a server-process that has only imported this module, rather than from the
+# server itself, whose other threads may hold locks at the time of a fork
+_PREPROCESS_CONTEXT = get_context("forkserver")
+_PREPROCESS_CONTEXT.set_forkserver_preload([__name__])
+
+# Preprocessing resources of a worker-process, set by its initializer
+_worker_resources = None
+
+
+def _init_preprocess_worker(*args) -> None:
+    global _worker_resources
+    _worker_resources = _preprocess_resources(*args)
+
+
+def _run_in_worker(func, chunk):
+    return func(chunk, _worker_resources)
+
+
+# A loaded version of an analyzer. Replaced as a whole when a new version is published, never modified while in use.
+Artifacts = namedtuple("Artifacts", ["version", "directory", "dictionary", "lsi_model", "index", "ann", "updates"])
+
 
 class SimilarityAnalyzer:
     def __init__(self, name: tuple, config: object) -> None:
@@ -15,24 +160,29 @@ class SimilarityAnalyzer:
             * name: Name of an instance. Used to differentiante persistent files between instances.
             * lang_code: ISO-code of the language, the analyzer will be formatted for.
         """
+        self.key = name
         self.name = "_".join(name)
         self.config = config
 
         if self.name.find(" ") != -1:
             self.name = "".join(self.name.split())
 
-        self.dictionary_filename = get_tmpfile(f"{self.name}.dictionary")
-        self.index_filename = get_tmpfile(f"{self.name}.index")
-        self.lsi_model_filename = get_tmpfile(f"{self.name}_lsi.model")
+        # Every trained version is kept in a directory of its own, the manifest tells which one is current
+        self.directory = os.path.join(self.config.MODEL_DIRECTORY, self.name)
+        self.manifest_filename = os.path.join(self.directory, MANIFEST_FILENAME)
+        self.manifest_mtime = None
+
+        self.index_backend = self.config.INDEX_BACKENDS.get(self.name, self.config.DEFAULT_INDEX_BACKEND)
 
         try:
             _language = self.config.ISOCODE_LANGUAGE_MAP[name[0]]
         except KeyError:
             _language = "english"
 
-        # Initializing requirements for text preprocessing
-        self.stoplist = self._prepare_stoplists(_language)
-        self.stemmer = self._prepare_stemmer(_language)
+        # Initializing requirements for text preprocessing, shared with other analyzers of the same language
+        self.language = _language
+        self.stoplist = get_stoplist(_language, tuple(self.config.CUSTOM_STOPWORDS))
+        self.stem_word, self.stem_cache = get_stemmer(_language)
 
         # Analyzer's inner errors
         self.errors = []
@@ -41,44 +191,28 @@ class SimilarityAnalyzer:
         self.update_time = None
 
         # Try to populate members from persistent storage.
-        self.dictionary = self._get_dictionary()
-        self.lsi_model = self._get_model()
-        self.index = self._get_index()
-
-
-    def _prepare_stemmer(self, language: str):
-        stemmers = {lang: SnowballStemmer for lang in SnowballStemmer.languages}
-        stemmers["english"] = WordNetLemmatizer
-        
-        stemmer = stemmers[language]
-        try:
-            return stemmer()
-        except TypeError:
-            return stemmer(language)
-            
-
-    def _prepare_stoplists(self, language: str):
-        _stopwords = set(stopwords.words(language))
-        _stopwords.update(self.config.CUSTOM_STOPWORDS)
-        return _stopwords
+        self.artifacts = None
+        self.refresh()
 
 
-    def train_with(self, documents: list) -> None:
+    def train_with(self, documents) -> None:
         """
         Build and train a document index and a model of the words of said documents. Also saves a persistent dictionary for later use.
+        The new version replaces the current one once it is complete, queries keep using the current one until then.
+
+        Documents are preprocessed a chunk at a time and their bags of words are streamed to disk, so the memory used does not grow
+        with the number of documents.
 
         Params:
-            documents: A list of texts for training data
+            documents: A list, or any other iterable of texts for training data (e.g. read from a file)
         """
         self.update_time = datetime.now()
 
-        wordlist = self._preprocess(documents)
-        self._build_dictionary_and_corpus(wordlist)
-        # Save dictionary to file, for faster spin-up in the future
-        self.dictionary.save(self.dictionary_filename)
-        self._build_model()
-        self._build_index()
-        self.errors = []
+        with self._lock(), self._staging() as staging:
+            dictionary = self._build_dictionary_and_corpus(documents, staging)
+            self._build(staging, dictionary, corpora.MmCorpus(os.path.join(staging, CORPUS_FILENAME)))
+
+            self._publish(staging)
 
 
     def get_state(self) -> dict:
@@ -86,29 +220,174 @@ class SimilarityAnalyzer:
         Returns a dictionary with key 'state' of string 'OK' if given instance should work as expected, 'NOK' if not and a timestamp of initial training and of last update, with keys 'init_time' and 'update_time' respectively.
         """
         state = "OK" if len(self.errors) == 0 else "NOK"
+        artifacts = self.artifacts
         return {
             "name": self.name,
-            "state": state, 
-            "init_time": self.init_time, 
-            "update_time": self.update_time
+            "state": state,
+            "init_time": self.init_time,
+            "update_time": self.update_time,
+            "version": None if artifacts is None else artifacts.version,
+            "index_backend": self.index_backend,
+            "recall_at_k": None if artifacts is None or artifacts.ann is None else artifacts.ann.meta["recall_at_k"]
         }
 
 
-    def _stem(self, text: list) -> list:
+    def _read_manifest(self):
         try:
-            stem = self.stemmer.lemmatize
-        except AttributeError:
-            stem = self.stemmer.stem
+            with open(self.manifest_filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
 
-        return [stem(w) for w in text]
+    def refresh(self) -> bool:
+        """
+        Switches to the current version of the manifest, if the manifest has changed since it was last read (e.g. by another process).
+        If the new version fails to load, the loaded one keeps serving queries and loading is retried on the next call.
+
+        Returns True, if a new version was loaded
+        """
+        try:
+            mtime = os.stat(self.manifest_filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if self.manifest_mtime is not None and mtime == self.manifest_mtime:
+            return False
+
+        manifest = self._read_manifest()
+        if manifest is None:
+            if self.artifacts is None:
+                self.errors = ["No trained version found."]
+            return False
+
+        if self.artifacts is not None and manifest["current"] == self.artifacts.version:
+            self.manifest_mtime = mtime
+            return False
+
+        errors = []
+        artifacts = self._load(manifest["current"], errors)
+        if artifacts is None:
+            # A loaded version keeps serving queries, and loading the new one is retried on the next refresh
+            if self.artifacts is None:
+                self.errors = errors
+            return False
+
+        # Swapped in one assignment, so a query uses either the old or the new version as a whole
+        self.artifacts = artifacts
+        self.errors = []
+        self.manifest_mtime = mtime
+        return True
+
+
+    def _load(self, version: str, errors: list):
+        # Tries to load every file of a version. Returns None, if any of them is missing.
+        directory = os.path.join(self.directory, version)
+
+        dictionary = self._get_dictionary(directory, errors)
+        lsi_model = self._get_model(directory, errors)
+        index = self._get_index(directory, errors)
+        ann = self._get_ann(directory, index)
+        updates = self._get_updates(directory, index)
+
+        if errors:
+            return None
+
+        return Artifacts(version, directory, dictionary, lsi_model, index, ann, updates)
+
+
+    @contextmanager
+    def _lock(self):
+        # Only one process at a time writes versions of the analyzer
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "manifest.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Staging-directories of a process that died while holding the lock are never published
+                for name in os.listdir(self.directory):
+                    if name.startswith(STAGING_PREFIX):
+                        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def _stage(self, link_from: str = None) -> str:
+        """
+        Creates a staging-directory for a new version. With 'link_from', the files of that version are hard-linked into it,
+        except for those that are saved by overwriting them.
+
+        Returns the path of the staging-directory
+        """
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f") + "-" + uuid.uuid4().hex[:6]
+        staging = os.path.join(self.directory, STAGING_PREFIX + version)
+        os.makedirs(staging)
+
+        if link_from is not None:
+            for root, _, filenames in os.walk(link_from):
+                target = os.path.join(staging, os.path.relpath(root, link_from))
+                os.makedirs(target, exist_ok=True)
+                for filename in filenames:
+                    if not filename.startswith(_UNLINKED_FILENAMES):
+                        os.link(os.path.join(root, filename), os.path.join(target, filename))
+
+        return staging
+
+
+    @contextmanager
+    def _staging(self, link_from: str = None):
+        # A staging-directory of a failed training or update is removed, instead of being left in the model directory
+        staging = self._stage(link_from)
+        try:
+            yield staging
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+
+    def _publish(self, staging: str) -> None:
+        """
+        Renames a complete staging-directory to a version-directory, makes it the current version in the manifest
+        and switches to it. Versions older than the last KEEP_VERSIONS are removed.
+        """
+        version = os.path.basename(staging)[len(STAGING_PREFIX):]
+        os.rename(staging, os.path.join(self.directory, version))
+
+        manifest = self._read_manifest() or {"key": list(self.key), "versions": []}
+        versions = manifest["versions"] + [version]
+        manifest["current"] = version
+        manifest["versions"] = versions[-self.config.KEEP_VERSIONS:]
+
+        with open(self.manifest_filename + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_filename + ".tmp", self.manifest_filename)
+
+        # Processes still using an old version keep their open files and mappings
+        for old_version in versions[:-self.config.KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(self.directory, old_version), ignore_errors=True)
+
+        self.refresh()
+
+
+    def _build(self, staging: str, dictionary: corpora.Dictionary, corpus) -> None:
+        # Train the model and build the index(es) of a new version from its corpus
+        lsi_model = self._build_model(staging, dictionary, corpus)
+        index = self._build_index(staging, lsi_model, corpus)
+        if self.index_backend == "ivf":
+            self._build_ann(staging, index)
+        self._save_updates(staging, self._new_updates(index))
+
+
+    def _stem(self, text: list) -> list:
+        return stem_text(text, self.stem_word, self.stem_cache, self.config.STEM_CACHE_SIZE)
+
+
+    def _tokenize(self, document) -> list:
+        return tokenize(document, self.stoplist)
 
 
     def _preprocess(self, documents: list) -> list:
-        # Remove common words and tokenize
-        texts = [
-            [word for word in str(document).lower().split() if word not in self.stoplist and len(word) > 1]
-            for document in documents if len(str(document)) > 1
-        ]
+        texts = [self._tokenize(document) for document in documents if len(str(document)) > 1]
 
         if len(documents) > 1:
             # Remove words that appear only once
@@ -125,51 +404,216 @@ class SimilarityAnalyzer:
         return [self._stem(text) for text in texts]
 
 
-    def _build_dictionary_and_corpus(self, documents: list) -> None:
-        self.dictionary = corpora.Dictionary(documents)
-        self.corpus = [self.dictionary.doc2bow(text) for text in documents]
+    def _doc2bow(self, documents: list, dictionary: corpora.Dictionary, allow_update: bool = False) -> list:
+        """
+        Preprocesses documents one at a time, so that every document keeps its position, and creates their bags of words.
+        With 'allow_update', new words are added to the dictionary.
+        """
+        processed_documents = [self._preprocess([document]) for document in documents]
+        return [
+            dictionary.doc2bow(processed[0] if processed else [], allow_update=allow_update)
+            for processed in processed_documents
+        ]
+
+
+    def _known(self, bows: list, lsi_model: models.LsiModel) -> list:
+        # Leaves out words added to the dictionary after the LSI-model was trained
+        return [[(token_id, count) for token_id, count in bow if token_id < lsi_model.num_terms] for bow in bows]
+
+
+    def _map_chunks(self, func, chunks, rare_words: frozenset = frozenset()):
+        """
+        Applies a preprocessing function to chunks in a pool of PREPROCESS_WORKERS processes, or in this process if just one.
+        Only a few chunks are read ahead of the results, so that streamed documents are not read into memory at once.
+
+        Yields the results in the order of the chunks
+        """
+        args = (self.language, tuple(self.config.CUSTOM_STOPWORDS), self.config.STEM_CACHE_SIZE, rare_words)
+        workers = self.config.PREPROCESS_WORKERS
+
+        if workers <= 1:
+            resources = _preprocess_resources(*args)
+            for chunk in chunks:
+                yield func(chunk, resources)
+            return
+
+        with _PREPROCESS_CONTEXT.Pool(workers, initializer=_init_preprocess_worker, initargs=args) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_run_in_worker, (func, chunk)))
+                if len(pending) > 2 * workers:
+                    yield pending.popleft().get()
 
+            while pending:
+                yield pending.popleft().get()
 
-    def _get_dictionary(self):
+
+    def _preprocess_chunks(self, documents, spill_directory: str):
+        """
+        Preprocesses an iterable of documents like '_preprocess' does a list of them, but a chunk at a time and in parallel.
+        Words appearing only once can only be known after every document has been read, so the tokenized chunks are spilled
+        to files for a second pass. The word counts of the chunks are merged in between.
+
+        Yields lists of preprocessed documents
+        """
+        frequency = Counter()
+        num_documents = 0
+        spill_filenames = []
+
+        def tasks():
+            nonlocal num_documents
+            for chunk in utils.grouper(documents, self.config.TRAINING_CHUNK_SIZE):
+                num_documents += len(chunk)
+                spill_filenames.append(os.path.join(spill_directory, f"{len(spill_filenames):08d}.jsonl"))
+                yield chunk, spill_filenames[-1]
+
+        os.makedirs(spill_directory)
         try:
-            return corpora.Dictionary.load(self.dictionary_filename)
+            for chunk_frequency in self._map_chunks(_tokenize_chunk, tasks()):
+                frequency.update(chunk_frequency)
+
+            # Remove words that appear only once, if there is more than one document
+            rare_words = frozenset(token for token, count in frequency.items() if count == 1) if num_documents > 1 else frozenset()
+
+            for lines in self._map_chunks(_stem_chunk, spill_filenames, rare_words):
+                yield [line.split() for line in lines.split("\n")[:-1]]
+        finally:
+            shutil.rmtree(spill_directory, ignore_errors=True)
+
+
+    def _build_dictionary_and_corpus(self, documents, directory: str) -> corpora.Dictionary:
+        """
+        Builds the dictionary while streaming the bags of words of the documents to the corpus-file of a version.
+        Both are the same as if built from every preprocessed document at once.
+
+        Returns the dictionary
+        """
+        dictionary = corpora.Dictionary()
+
+        def corpus():
+            for texts in self._preprocess_chunks(documents, os.path.join(directory, "tokens")):
+                # Pruning would renumber the words of the bags of words already written, so the dictionary is never pruned
+                dictionary.add_documents(texts, prune_at=None)
+                for text in texts:
+                    yield dictionary.doc2bow(text)
+
+        # Save the corpus to file, for retraining after incremental updates
+        corpora.MmCorpus.serialize(os.path.join(directory, CORPUS_FILENAME), corpus())
+        # Save dictionary to file, for faster spin-up in the future
+        dictionary.save(os.path.join(directory, DICTIONARY_FILENAME))
+        return dictionary
+
+
+    def _get_dictionary(self, directory: str, errors: list):
+        try:
+            return corpora.Dictionary.load(os.path.join(directory, DICTIONARY_FILENAME))
         except FileNotFoundError:
-            self.errors.append("Dictionary not found,")
+            errors.append("Dictionary not found,")
             return None
 
 
-    def _get_model(self):
+    def _get_model(self, directory: str, errors: list):
         # Tries to load the LSI-model
         try:
-            return models.LsiModel.load(self.lsi_model_filename)
+            return models.LsiModel.load(os.path.join(directory, LSI_MODEL_FILENAME))
         except FileNotFoundError:
-            self.errors.append("LSI-model not found.")
+            errors.append("LSI-model not found.")
             return None
 
 
-    def _build_model(self) -> None:
+    def _build_model(self, directory: str, dictionary: corpora.Dictionary, corpus) -> models.LsiModel:
         # Create LSI-model
-        self.lsi_model = models.LsiModel(self.corpus, id2word=self.dictionary, num_topics=self.config.NUM_TOPICS)
+        lsi_model = models.LsiModel(corpus, id2word=dictionary, num_topics=self.config.NUM_TOPICS)
 
         # Save model to file, for faster spin-up in the future
-        self.lsi_model.save(self.lsi_model_filename)
+        lsi_model.save(os.path.join(directory, LSI_MODEL_FILENAME))
+        return lsi_model
 
 
-    def _get_index(self):
+    def _get_index(self, directory: str, errors: list):
         # Tries to load a persistent document index
         try:
-            return similarities.MatrixSimilarity.load(self.index_filename)
+            return ShardedIndex.load(os.path.join(directory, INDEX_FILENAME), self.config.INDEX_WORKERS)
+        except FileNotFoundError:
+            errors.append("Document-index not found.")
+            return None
+
+
+    def _build_index(self, directory: str, lsi_model: models.LsiModel, corpus) -> ShardedIndex:
+        # Transform corpus to LSI space a shard at a time, and save it as the index
+        chunks = (self._project(chunk, lsi_model) for chunk in utils.grouper(corpus, self.config.INDEX_SHARD_SIZE))
+        return ShardedIndex.build(os.path.join(directory, INDEX_FILENAME), chunks, lsi_model.num_topics,
+                                  self.config.INDEX_SHARD_SIZE, self.config.INDEX_WORKERS)
+
+
+    def _get_ann(self, directory: str, index: ShardedIndex):
+        # Tries to load the approximate nearest-neighbour index, if the analyzer is set to use one
+        if self.index_backend != "ivf" or index is None:
+            return None
+
+        try:
+            return IVFIndex(os.path.join(directory, ANN_FILENAME), index, self.config.IVF_NUM_PROBES)
         except FileNotFoundError:
-            self.errors.append("Document-index not found.")
+            # Version trained before the analyzer was set to use one. Published versions are never modified,
+            # the next training or update builds it in its staging-directory
+            logger.warning(f"No ivf-index in version {os.path.basename(directory)} of {self.name}, using exact search")
             return None
 
 
-    def _build_index(self) -> None:
-        # Transform corpus to LSI space and index it
-        self.index = similarities.MatrixSimilarity(self.lsi_model[self.corpus])
+    def _build_ann(self, directory: str, index: ShardedIndex) -> IVFIndex:
+        # Cluster the indexed documents, and measure the recall against exact search on them
+        return IVFIndex.build(os.path.join(directory, ANN_FILENAME), index, self.config.IVF_NUM_LISTS,
+                              self.config.IVF_NUM_PROBES, self.config.IVF_TRAINING_SAMPLE,
+                              self.config.IVF_RECALL_SAMPLE, self.config.DEFAULT_TOP_N)
+
+
+    def _searcher(self, artifacts: Artifacts):
+        # Approximate index if in use, exact otherwise
+        return artifacts.index if artifacts.ann is None else artifacts.ann
+
+
+    def _project(self, bows: list, lsi_model: models.LsiModel) -> np.ndarray:
+        """
+        Converts bags of words to LSI space, all of them with one sparse matrix product.
+
+        Returns an array of unit-length LSI-vectors, one row per bag of words
+        """
+        # Stack the bags of words as the columns of a sparse matrix
+        bow_matrix = matutils.corpus2csc(bows, num_terms=lsi_model.num_terms, num_docs=len(bows))
+
+        # Project to LSI space, like the model does for a single bag of words
+        vectors = bow_matrix.T @ lsi_model.projection.u[:, :lsi_model.num_topics]
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+
+    def batch_similarities(self, queries: list) -> np.ndarray:
+        """
+        Scores many queries against every added document with a single matrix-matrix product.
+
+        Params:
+            queries: List of texts for which similar texts are wanted
+
+        Returns an array of document-similarities with one row per query, indexed by document-number
+        """
+        artifacts = self.artifacts
+
+        # Run same preprocess as with training-data
+        bows = self._known(self._doc2bow(queries, artifacts.dictionary), artifacts.lsi_model)
+        return self._searcher(artifacts).similarities(self._project(bows, artifacts.lsi_model))
+
+
+    def similarities(self, query: str) -> np.ndarray:
+        """
+        Scores a query against every added document.
+
+        Params:
+            query: Text for which similar texts are wanted
 
-        # Save index to file, for faster spin-up in the future
-        self.index.save(self.index_filename)
+        Returns an array of document-similarities, indexed by document-number
+        """
+        return self.batch_similarities([query])[0]
 
 
     def run_query(self, query: str) -> list:
@@ -179,39 +623,132 @@ class SimilarityAnalyzer:
         Params:
             query: Text for which similar texts are wanted
 
-        Returns a list of tuples (document-number, document-similarity)
+        Returns a list of [document-number, document-similarity] pairs, sorted by descending similarity
         """
         # If dictionary not setup correctly, return a list of errors
-        if self.dictionary == None:
+        if self.artifacts is None:
             return self.errors
 
-        # Run same preprocess as with training-data
-        processed_query = self._preprocess([query])[0]
+        # Every document is returned, so a full sort is needed (the top-n of many documents are picked with top_k)
+        sims = self.similarities(query)
+        return [[int(document_id), float(sims[document_id])] for document_id in np.argsort(-sims, kind="stable")]
 
-        # Create a bag of words from the query
-        vec_bow = self.dictionary.doc2bow(processed_query)
 
-        # Convert the query to LSI space
-        vec_lsi = self.lsi_model[vec_bow]
+    def _new_updates(self, index: ShardedIndex) -> dict:
+        return {
+            "trained_documents": 0 if index is None else len(index),
+            "tokens": 0,
+            "unknown_tokens": 0,
+            "pending": []
+        }
+
 
-        # Perform a similarity query against the corpus
-        sims = self.index[vec_lsi]
+    def _get_updates(self, directory: str, index: ShardedIndex) -> dict:
+        # Tries to load the bookkeeping of incremental updates since the last full training
+        try:
+            with open(os.path.join(directory, UPDATES_FILENAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self._new_updates(index)
 
-        # (document_number, document_similarity) 2-tuples, sorted by negated similarity-value
-        sims = sorted(enumerate(sims), key=lambda item: -item[1])
 
-        results = list()
+    def _save_updates(self, directory: str, updates: dict) -> None:
+        with open(os.path.join(directory, UPDATES_FILENAME), "w") as f:
+            json.dump(updates, f)
+
+
+    def _drifted(self, updates: dict) -> bool:
+        """
+        Returns True, if the updates since the last full training have drifted too far from the trained model.
+        That is, if too many documents have been added, or too many of their words are unknown to the LSI-model.
+        """
+        added = len(updates["pending"])
+        if added > self.config.MAX_UPDATED_DOCUMENTS_RATIO * updates["trained_documents"]:
+            return True
+
+        tokens = updates["tokens"]
+        return tokens > 0 and updates["unknown_tokens"] > self.config.MAX_UNKNOWN_TOKENS_RATIO * tokens
+
+
+    def _retrain(self, staging: str, dictionary: corpora.Dictionary, updates: dict) -> bool:
+        """
+        Retrains the LSI-model and rebuilds the index in a staging-directory, from its corpus and the updated documents.
+
+        Returns False, if there is no saved corpus to retrain from
+        """
+        corpus_filename = os.path.join(staging, CORPUS_FILENAME)
+        if not os.path.exists(corpus_filename):
+            return False
 
-        for tup in enumerate(sims):
-            s = tup[1]
-            # Add a list of (document_number, document_similarity) to results-list
-            results.append([s[0], float(s[1])])
+        pending = [[tuple(item) for item in bow] for bow in updates["pending"]]
+        corpus = chain(corpora.MmCorpus(corpus_filename), pending)
 
-        # Listify the set for better compatibility
-        return results
+        # The corpus is hard-linked to the current version's, so the combined corpus replaces the link instead of overwriting it
+        corpora.MmCorpus.serialize(corpus_filename + ".tmp", corpus)
+        os.replace(corpus_filename + ".tmp", corpus_filename)
+        os.replace(corpus_filename + ".tmp.index", corpus_filename + ".index")
 
+        self._build(staging, dictionary, corpora.MmCorpus(corpus_filename))
+        return True
 
-    def update_model(self, entry: str) -> dict:
+
+    def update_model(self, entries: list) -> dict:
+        """
+        Adds new documents to the dictionary, to the LSI-model and to the end of the document index, without a full retraining.
+        Retrains fully, once the updates have drifted too far from the trained model.
+        The result is published as a new version, queries keep using the current one until then.
+
+        Params:
+            entries: A list of texts to add
+
+        Returns a dictionary with the name of the analyzer, the document-numbers of the added texts and whether a full retraining was done, with keys 'name', 'document_ids' and 'retrained' respectively.
+        Raises a RuntimeError, if the analyzer has not been trained.
+        """
         self.update_time = datetime.now()
-        #self.lsi_model.add_documents()
-        return {self.name: f"Updated on {self.update_time}"}
+
+        with self._lock():
+            # Start from the latest version, even if another process published it
+            self.refresh()
+            current = self.artifacts
+
+            # Only a trained version can be updated
+            if current is None:
+                raise RuntimeError(f"Analyzer '{self.name}' has no trained version to update: {' '.join(self.errors)}")
+
+            with self._staging(link_from=current.directory) as staging:
+                # Private copies of the dictionary and the model, the current ones keep serving queries
+                dictionary = corpora.Dictionary.load(os.path.join(current.directory, DICTIONARY_FILENAME))
+                lsi_model = models.LsiModel.load(os.path.join(current.directory, LSI_MODEL_FILENAME))
+                index = ShardedIndex.load(os.path.join(staging, INDEX_FILENAME), self.config.INDEX_WORKERS)
+
+                # Words new to the dictionary are only used by the LSI-model after a full retraining
+                bows = self._doc2bow(entries, dictionary, allow_update=True)
+                known_bows = self._known(bows, lsi_model)
+
+                lsi_model.add_documents(known_bows)
+
+                # Append the new documents to the index
+                first_id = len(index)
+                index.append(self._project(known_bows, lsi_model))
+
+                updates = dict(current.updates)
+                updates["tokens"] += sum(count for bow in bows for _, count in bow)
+                updates["unknown_tokens"] += sum(count for bow in bows for token_id, count in bow if token_id >= lsi_model.num_terms)
+                updates["pending"] = updates["pending"] + bows
+
+                dictionary.save(os.path.join(staging, DICTIONARY_FILENAME))
+
+                retrained = self._drifted(updates) and self._retrain(staging, dictionary, updates)
+                if not retrained:
+                    lsi_model.save(os.path.join(staging, LSI_MODEL_FILENAME))
+                    self._save_updates(staging, updates)
+                    if self.index_backend == "ivf" and current.ann is None:
+                        self._build_ann(staging, index)
+
+                self._publish(staging)
+
+        return {
+            "name": self.name,
+            "document_ids": list(range(first_id, first_id + len(entries))),
+            "retrained": retrained
+        }
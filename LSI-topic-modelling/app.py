@@ -1,9 +1,16 @@
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
-from collections import defaultdict
-
-from config.config import FlaskConfig, AnalyzerConfig
+import os
+import json
+import threading
+import numpy as np
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import FlaskConfig, AnalyzerConfig, ClientConfig
+from misc.data_reader import iter_column
 from analysis.similarity_analyzer import SimilarityAnalyzer
+from analysis.index import top_k
 
 if __name__ != "__main__":
     from logging.config import dictConfig
@@ -32,6 +39,13 @@ db = SQLAlchemy(app)
 
 analyzers = {}
 
+# Entries of a query that are not texts to analyze ('log_date' is sent by the client with every query)
+AUX_KEYS = ("top_n", "language", "dataset", "log_date")
+
+# Set once the analyzers found in the model directory at startup have been loaded
+ready = threading.Event()
+load_times = {}
+
 def filter_languages(data: dict):
     valid_languages = AnalyzerConfig.ISOCODE_LANGUAGE_MAP
     if isinstance(data["language"], list):
@@ -54,9 +68,8 @@ def register_existing_analyzers(data: dict):
     _languages = filter_languages(data)
     _dataset = data["dataset"]
 
-    aux_keys = ("top_n", "language", "dataset")
     # Filter auxiliary entries from data (to stop trying to ressurect analyzers for 'top_n' for example)
-    _data = {key: data[key] for key in data if key not in aux_keys}
+    _data = {key: data[key] for key in data if key not in AUX_KEYS}
 
     for language in _languages:
         for _key in list(_data.keys()):
@@ -71,74 +84,229 @@ def register_existing_analyzers(data: dict):
                 app.logger.info(f"Respawned {state['name']}-analyzer")
 
 
-@app.route("/find_similar", methods = ['POST'])
-def find_similar():
+def discover_analyzers() -> list:
     '''
-    Tries to find similar issues from the AIC's database.
-    Returns a json-object, with the key: 'similar' and a list of dictionaries of {document_id: int, similarity_score: float} as value.
+    Returns the keys (language, field, dataset) of every analyzer with a trained version in the model directory.
     '''
-    data = request.get_json()
+    keys = []
+    directory = AnalyzerConfig.MODEL_DIRECTORY
+    names = os.listdir(directory) if os.path.isdir(directory) else []
 
-    active_language = data["language"]
-    if active_language not in AnalyzerConfig.ISOCODE_LANGUAGE_MAP:
-        return jsonify({"similar": {"language": f"{active_language} not supported"}})
+    for name in names:
+        try:
+            with open(os.path.join(directory, name, "manifest.json")) as f:
+                keys.append(tuple(json.load(f)["key"]))
+        except (FileNotFoundError, KeyError, ValueError):
+            app.logger.info(f"No manifest found for '{name}', skipping")
+
+    return keys
+
+
+def load_analyzer(key: tuple) -> None:
+    start = perf_counter()
+    analyzer = SimilarityAnalyzer(key, AnalyzerConfig)
+    state = analyzer.get_state()
+    load_times[state["name"]] = round(perf_counter() - start, 3)
+
+    if state["state"] == "NOK":
+        app.logger.info(f"Failed to load {state['name']}: {analyzer.errors}")
+    else:
+        analyzers[key] = analyzer
+        app.logger.info(f"Loaded {state['name']}-analyzer (version {state['version']}) in {load_times[state['name']]} seconds")
+
+
+def warm_up() -> None:
+    '''
+    Loads every analyzer found in the model directory concurrently, and then marks the app ready.
+    '''
+    start = perf_counter()
+    keys = discover_analyzers()
+
+    try:
+        with ThreadPoolExecutor(max_workers=AnalyzerConfig.WARMUP_WORKERS) as pool:
+            for future in [pool.submit(load_analyzer, key) for key in keys]:
+                try:
+                    future.result()
+                except Exception as e:
+                    app.logger.error(f"Failed to load an analyzer: {e}")
+    finally:
+        ready.set()
+
+    app.logger.info(f"Loaded {len(analyzers)} of {len(keys)} analyzers in {round(perf_counter() - start, 2)} seconds")
+
+
+# Warm up in the background, so the server can answer '/ready' meanwhile
+threading.Thread(target=warm_up, daemon=True).start()
 
+
+def fuse_scores(total: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    '''
+    Adds an analyzer's similarity-scores to the running total, element-wise by document-number.
+    Analyzers with fewer documents leave the scores of the remaining documents unchanged.
+    '''
+    scores = scores.astype(np.float64)
+    if total is None:
+        return scores
+
+    if scores.shape[-1] > total.shape[-1]:
+        total, scores = scores, total
+    total[..., :scores.shape[-1]] += scores
+
+    return total
+
+
+def query_analyzers(data: dict, batch: slice = None) -> tuple:
+    '''
+    Scores the query against every working analyzer and sums their similarity-scores together.
+    With 'batch', every field of the query is a list of texts and the given slice of them is scored at once.
+    Returns a tuple of the summed similarity-scores (None if no analyzer could be used) and the number of analyzers used.
+    '''
     # TODO Get rid of globals
     global analyzers
 
-    try:
-        top_n = int(data["top_n"])
-    except KeyError:
-        # If 'top_n' not specified in request, defaults to this
-        top_n = AnalyzerConfig.DEFAULT_TOP_N
+    # Queries wait for the warm-up, instead of respawning the analyzers it is loading
+    ready.wait()
 
     # If no analyzers activated, try and respawn from persistent storage
     if len(analyzers) == 0:
         register_existing_analyzers(data)
 
-    total = defaultdict(float)
+    total = None
 
     used_keys = []
 
     for key in analyzers:
+        # Auxiliary entries are never scored, in single and batched queries alike
+        if key[1] in AUX_KEYS:
+            continue
+
+        # Switch to a version published by another worker, if there is one
+        analyzers[key].refresh()
         state = analyzers[key].get_state()
+        app.logger.info(str(state))
         if state["state"] == "NOK":
-            pass
+            continue
 
         used_keys.append(key)
 
         # Sum similarity-scores together for each unique ID from each distinct analyzer
         try:
-            for sim in analyzers[key].run_query(data[key[1]]):
-                total[sim[0]] += sim[1]
+            if batch is None:
+                scores = analyzers[key].similarities(data[key[1]])
+            else:
+                scores = analyzers[key].batch_similarities(data[key[1]][batch])
+            total = fuse_scores(total, scores)
         except KeyError:
             pass
 
-        app.logger.info(str(state))
+    return total, len(used_keys)
+
 
-    # Sort by highest similarity-score
-    sims = sorted(total.items(), key=lambda item: item[1], reverse=True)
+def get_top_n(data: dict) -> int:
+    try:
+        return int(data["top_n"])
+    except KeyError:
+        # If 'top_n' not specified in request, defaults to this
+        return AnalyzerConfig.DEFAULT_TOP_N
 
-    # Include only top-n of the sorted similarities
-    sims = sims[:top_n]
 
+def to_similar(ids: np.ndarray, scores: np.ndarray, used_keys: int) -> list:
     # Rearrange similarities to dictionary-form, for increased clarity of response
-    sims_dict = [{
-        "document_id": sim[0], 
-        "similarity_score": sim[1] / len(used_keys)
-        } for sim in sims]
+    return [{
+        "document_id": int(doc_id), 
+        "similarity_score": float(score) / used_keys
+        } for doc_id, score in zip(ids, scores)]
+
+
+@app.route("/find_similar", methods = ['POST'])
+def find_similar():
+    '''
+    Tries to find similar issues from the AIC's database.
+    Returns a json-object, with the key: 'similar' and a list of dictionaries of {document_id: int, similarity_score: float} as value.
+    '''
+    data = request.get_json()
+
+    active_language = data["language"]
+    if active_language not in AnalyzerConfig.ISOCODE_LANGUAGE_MAP:
+        return jsonify({"similar": {"language": f"{active_language} not supported"}})
+
+    top_n = get_top_n(data)
+
+    total, used_keys = query_analyzers(data)
+
+    if total is None:
+        return jsonify({"similar": []})
+
+    # Include only top-n, sorted by highest similarity-score
+    ids, scores = top_k(total, top_n)
+
+    return jsonify({"similar": to_similar(ids, scores, used_keys)})
+
+
+@app.route("/find_similar_batch", methods = ['POST'])
+def find_similar_batch():
+    '''
+    Tries to find similar issues for many queries at once. Each field of the query is a list of texts, list-indexes of each separate list corresponding to a single query.
+    Returns a json-object, with the key: 'similar' and a list with the result of each query, formatted like in 'find_similar'.
+    '''
+    data = request.get_json()
+
+    active_language = data["language"]
+    if active_language not in AnalyzerConfig.ISOCODE_LANGUAGE_MAP:
+        return jsonify({"similar": {"language": f"{active_language} not supported"}})
+
+    top_n = get_top_n(data)
+
+    # Every query field is a list of texts, one per query
+    fields = [key for key in data if key not in AUX_KEYS]
+    if not all(isinstance(data[key], list) for key in fields) or len(set(len(data[key]) for key in fields)) > 1:
+        return jsonify({"status": 400, "fields": "Query fields must be lists of the same length"}), 400
+
+    num_queries = len(data[fields[0]]) if fields else 0
 
-    return jsonify({"similar": sims_dict})
+    results = []
+
+    # Queries are scored in batches, to keep the score-matrix (queries x documents) in bounds
+    for start in range(0, num_queries, AnalyzerConfig.QUERY_BATCH_SIZE):
+        batch = slice(start, min(start + AnalyzerConfig.QUERY_BATCH_SIZE, num_queries))
+        total, used_keys = query_analyzers(data, batch)
+
+        if total is None:
+            results += [[] for _ in range(batch.stop - batch.start)]
+            continue
+
+        ids, scores = top_k(total, top_n)
+        results += [to_similar(_ids, _scores, used_keys) for _ids, _scores in zip(ids, scores)]
+
+    return jsonify({"similar": results})
+
+
+@app.route("/ready", methods = ['GET'])
+def is_ready():
+    '''
+    Health-check for the analyzers loaded at startup.
+    Returns a status object with HTTP-status 200 once they are all loaded, and 503 before that. Lists the load time of each analyzer in seconds.
+    '''
+    if not ready.is_set():
+        return jsonify({"status": 503, "load_times": load_times}), 503
+
+    return jsonify({"status": 200, "analyzers": [analyzer.name for analyzer in analyzers.values()], "load_times": load_times})
 
 
 @app.route("/training_data", methods = ['POST'])
 def training_data():
     '''
     Builds the analyzer-objects according to 'keys'-field in received data.
+    Instead of lists of texts, the data can name a 'file' in the sanitized files directory, from which the columns are streamed.
     Returns a status object.
     '''
     data = request.get_json()
 
+    if "file" in data:
+        path = os.path.join(ClientConfig.SANITIZED_FILES_DIRECTORY, os.path.basename(data["file"]))
+        if not os.path.isfile(path):
+            return jsonify({"status": 400, "file": f"{data['file']} not found"})
+
     keys = data["keys"]
 
     _languages = filter_languages(data)
@@ -149,15 +317,20 @@ def training_data():
     for language in _languages:
         for _key in keys:
             key = (language, _key, data["dataset"])
-            analyzers[key] = SimilarityAnalyzer(key, AnalyzerConfig)
-            state = analyzers[key].get_state()
+            # A retrained analyzer keeps answering queries with its current version, until the new one is ready
+            analyzer = analyzers.get(key) or SimilarityAnalyzer(key, AnalyzerConfig)
+            state = analyzer.get_state()
 
             if state["state"] == "NOK":
                 app.logger.info(f"Commencing initial training of '{state['name']}'-analyzer")
             else:
                 app.logger.info(f"Commencing retraining of '{state['name']}'-analyzer")
 
-            analyzers[key].train_with(data[_key])
+            if "file" in data:
+                analyzer.train_with(iter_column(path, _key, AnalyzerConfig.TRAINING_CHUNK_SIZE))
+            else:
+                analyzer.train_with(data[_key])
+            analyzers[key] = analyzer
 
     return jsonify({"status": 200})
 
@@ -165,22 +338,40 @@ def training_data():
 @app.route("/update", methods = ['POST'])
 def update():
     '''
-    Updates the analyzers for which the new data has keys for.
-    Returns a status object.
+    Updates the analyzers for which the new data has keys for, adding the new entries to them incrementally.
+    Returns a status object, with the document-IDs given to the entries by each updated analyzer.
     '''
     data = request.get_json()
 
+    _languages = filter_languages(data)
+
     # TODO Get rid of globals
     global analyzers
 
-    #app.logger.info("Updating model(s)")
-    #updated = [analyzer.update_model(data[key]) for key, analyzer in analyzers.items() if key in data]
-    #app.logger.info(str(updated))
+    ready.wait()
 
-    # HTTP-code 501 stands for 'Not Implemented'
-    return jsonify({"status": 501})
+    # If no analyzers activated, try and respawn from persistent storage
+    if len(analyzers) == 0:
+        register_existing_analyzers(data)
+
+    updated = []
+
+    for key, analyzer in analyzers.items():
+        language, _key, dataset = key
+        if language not in _languages or dataset != data["dataset"] or _key not in data:
+            continue
+
+        if analyzer.get_state()["state"] == "NOK":
+            app.logger.info(f"Skipping update of '{analyzer.name}'-analyzer, which is not trained")
+            continue
+
+        # Accepts a single entry, or a list of entries like 'training_data'
+        entries = data[_key] if isinstance(data[_key], list) else [data[_key]]
+        updated.append(analyzer.update_model(entries))
+
+    app.logger.info("Updated model(s): " + str(updated))
 
-    #return jsonify({"status": 200})
+    return jsonify({"status": 200, "updated": updated})
 
 
 @app.route("/used_suggestion", methods = ['POST'])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Benchmark preprocessing the training documents (tokenizing, filtering and stemming)
+with a growing number of worker-processes.
+
+Synthetic documents are drawn from a Zipf-distributed vocabulary, so that there are
+both frequent words and words appearing only once. Every run is checked to produce
+the same texts as preprocessing all the documents at once in memory (_preprocess),
+which is also the baseline of the speedup.
+
+    ~$ python benchmarks/preprocess_benchmark.py --documents 200000
+    ~$ python benchmarks/preprocess_benchmark.py --documents 50000 --workers 1 2 4 --language fi
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.config import AnalyzerConfig
+from analysis.similarity_analyzer import SimilarityAnalyzer
+
+
+def make_documents(num_documents: int, vocabulary_size: int, seed: int = 42) -> list:
+    # Documents of 5-40 words, drawn from a vocabulary of random lowercase words
+    rng = np.random.RandomState(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocabulary = ["".join(rng.choice(letters, rng.randint(2, 12))) for _ in range(vocabulary_size)]
+
+    documents = []
+    for length in rng.randint(5, 41, num_documents):
+        words = np.minimum(rng.zipf(1.3, length), vocabulary_size) - 1
+        documents.append(" ".join(vocabulary[i] for i in words))
+    return documents
+
+
+def run(analyzer: SimilarityAnalyzer, documents: list, workers: int) -> tuple:
+    # Preprocesses the documents with the given number of worker-processes, returns the texts and the runtime
+    analyzer.config.PREPROCESS_WORKERS = workers
+    spill_directory = os.path.join(analyzer.config.MODEL_DIRECTORY, f"tokens-{workers}")
+
+    start = time.perf_counter()
+    texts = [text for chunk in analyzer._preprocess_chunks(iter(documents), spill_directory) for text in chunk]
+    return texts, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--documents", type=int, default=200000, help="number of synthetic documents")
+    ap.add_argument("-v", "--vocabulary", type=int, default=100000, help="size of the synthetic vocabulary")
+    ap.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="worker-process counts to run")
+    ap.add_argument("-c", "--chunk-size", type=int, default=AnalyzerConfig.TRAINING_CHUNK_SIZE, help="documents per chunk")
+    ap.add_argument("-l", "--language", default="en", help="ISO-code of the language to preprocess as")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as model_directory:
+
+        class BenchmarkConfig(AnalyzerConfig):
+            MODEL_DIRECTORY = model_directory
+            TRAINING_CHUNK_SIZE = args.chunk_size
+
+        print(f"... generating {args.documents} documents")
+        documents = make_documents(args.documents, args.vocabulary)
+        analyzer = SimilarityAnalyzer((args.language, "benchmark", "preprocess"), BenchmarkConfig)
+
+        # Every run must match preprocessing all the documents at once in memory, token for token
+        start = time.perf_counter()
+        reference = analyzer._preprocess(documents)
+        reference_runtime = time.perf_counter() - start
+
+        print(f"{'workers':>9} {'runtime':>10} {'docs/s':>10} {'speedup':>8} {'identical':>10}")
+        print(f"{'in-memory':>9} {reference_runtime:>9.2f}s {len(documents) / reference_runtime:>10.0f} {1:>7.2f}x {'-':>10}")
+        for workers in args.workers:
+            texts, runtime = run(analyzer, documents, workers)
+            print(f"{workers:>9} {runtime:>9.2f}s {len(documents) / runtime:>10.0f} "
+                  f"{reference_runtime / runtime:>7.2f}x {str(texts == reference):>10}")
@@ -23,6 +23,21 @@ class ClientConfig:
     SANITIZED_FILES_DIRECTORY = "training_data"
 
 
+class SanitizerConfig:
+    WORKERS = os.cpu_count() or 1 # Worker-processes sanitizing texts, each loads the spaCy-pipelines it needs once
+    TASK_SIZE = 1000 # Texts sent to a worker-process at a time
+    NER_BATCH_SIZE = 256 # Texts of a language parsed at a time by its spaCy-pipeline
+    SPACY_MODELS = {"en": "en_core_web_sm"} # spaCy-package per language ISO-code, others are looked for as '<ISO-code>_core_news_sm'
+    MULTILINGUAL_MODEL = "xx_ent_wiki_sm" # Used for the languages without an installed package
+    MAX_LOADED_MODELS = 4 # spaCy-pipelines kept loaded per process, the least recently used one is dropped first
+    DEFAULT_LANGUAGE = "en" # Language of the texts detected as none of ISOCODE_LANGUAGE_MAP, or of rows with only short texts
+    LANGDETECT_SEED = 0 # Makes langdetect deterministic across runs
+    LANGUAGE_CACHE_SIZE = 1000000 # Detected languages cached by a hash of their (normalized) texts
+    LANGUAGE_FAST_PATH = True # Texts shorter than SHORT_TEXT_LENGTH take the language of their row instead of being detected
+    SHORT_TEXT_LENGTH = 20 # Characters
+    STREAM_CHUNK_SIZE = 10000 # Rows sanitized at a time, when streaming a file
+
+
 class AnalyzerConfig:
     ISOCODE_LANGUAGE_MAP = {
             "en": "english",
@@ -42,5 +57,22 @@ class AnalyzerConfig:
             "sv": "swedish"
         }
     CUSTOM_STOPWORDS = ["--retracted--", "xxx@email.zz"]
+    STEM_CACHE_SIZE = 1000000 # Most distinct words, whose stems are cached per language
+    MODEL_DIRECTORY = os.environ.get('MODEL_DIRECTORY') or "models" # Trained versions of the analyzers are kept here
+    KEEP_VERSIONS = 2 # Trained versions kept per analyzer, older ones are removed
+    WARMUP_WORKERS = 4 # Threads loading the trained analyzers at startup
     NUM_TOPICS = 16
+    TRAINING_CHUNK_SIZE = 10000 # Training documents preprocessed at a time
+    PREPROCESS_WORKERS = os.cpu_count() or 1 # Processes preprocessing the training documents, 1 preprocesses them in the server's process
     DEFAULT_TOP_N = 10 # The app returns this many results, if not otherwise specified in the request
+    INDEX_SHARD_SIZE = 100000 # Documents per memory-mapped shard of a document-index
+    INDEX_WORKERS = 4 # Threads querying the shards of the document-indexes in parallel
+    DEFAULT_INDEX_BACKEND = "exact" # "exact" scores every document, "ivf" only the documents of the k-means clusters closest to a query
+    INDEX_BACKENDS = {} # Index backend per analyzer-name (e.g. {"en_body_tickets": "ivf"}), overriding DEFAULT_INDEX_BACKEND
+    IVF_NUM_LISTS = None # Number of k-means clusters of an ivf-index, the square root of the number of documents if None
+    IVF_NUM_PROBES = 8 # Closest clusters scored per query
+    IVF_TRAINING_SAMPLE = 100000 # Documents the clusters are fitted on
+    IVF_RECALL_SAMPLE = 1000 # Indexed documents queried for measuring recall@k (k = DEFAULT_TOP_N) against exact search, when building
+    QUERY_BATCH_SIZE = 64 # Queries of a batch-request scored at once, bounds the memory used for the scores
+    MAX_UPDATED_DOCUMENTS_RATIO = 0.2 # Updates trigger a full retraining, once they have added this share of the trained documents
+    MAX_UNKNOWN_TOKENS_RATIO = 0.1 # ... or once this share of their words are unknown to the trained LSI-model
@@ -7,33 +7,69 @@ from typing import Union, List, Set, Tuple
 READERS = {
     ".csv": (pd.read_csv, {"delimiter": ";"}),
     ".json": (pd.read_json, {}),
+    ".jsonl": (pd.read_json, {"lines": True}),
     ".xlsx": (pd.read_excel, {}),
     ".xls": (pd.read_excel, {})
 }
 
+# Formats that can be read a chunk of rows at a time
+STREAMABLE_SUFFIXES = (".csv", ".jsonl")
+
+# Rows read of a streamed file for choosing its columns
+PREVIEW_ROWS = 100
+
 
 def _get_file_suffix(filename: str) -> str:
     return filename[filename.rfind("."):]
 
 
-def _arg_parse() -> Tuple[str, Set[str]]:
+def iter_rows(path: str, chunksize: int = 10000):
+    """
+    Reads a file a chunk of rows at a time, if it is a csv- or json-lines-file, other formats whole.
+
+    Yields dataframes
+    """
+    suffix = _get_file_suffix(path)
+    reader, args = READERS[suffix]
+
+    if suffix in STREAMABLE_SUFFIXES:
+        yield from reader(path, chunksize=chunksize, **args)
+    else:
+        yield reader(path, **args)
+
+
+def iter_column(path: str, column: str, chunksize: int = 10000):
+    """
+    Reads the values of a column from a file. csv- and json-lines-files are read a chunk of rows at a time, other formats whole.
+
+    Yields the values of the column
+    """
+    for chunk in iter_rows(path, chunksize):
+        yield from chunk[column]
+
+
+def _arg_parse() -> Tuple[str, Set[str], bool]:
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--filename", default="", required=False, help="Insert a filename from test_data-folder to be parsed")
     parser.add_argument("-c", "--columns", default="", required=False, help="Insert columns to sanitize. Separate with commas")
+    parser.add_argument("-s", "--stream", action="store_true", help="Read csv- and json-lines-files a chunk of rows at a time")
     args = parser.parse_args()
 
     filename = args.filename
     columns = set(args.columns.split(","))
 
-    return (filename, columns)
+    return (filename, columns, args.stream)
 
 
-def _get_data(data_dir: str, filename: str) -> Union[pd.DataFrame, List[str]]:
+def _get_data(data_dir: str, filename: str, nrows: int = None) -> Union[pd.DataFrame, List[str]]:
     path = os.path.join(data_dir, filename)
 
-    reader, args = READERS[_get_file_suffix(filename)]
-
-    dataframe = reader(path, **args)
+    if nrows is not None:
+        # Only the first chunk of rows is read
+        dataframe = next(iter_rows(path, nrows))
+    else:
+        reader, args = READERS[_get_file_suffix(filename)]
+        dataframe = reader(path, **args)
     columns = dataframe.columns.values
 
     return dataframe, columns
@@ -43,13 +79,17 @@ def read_data(data_dir: str) -> Union[pd.DataFrame, Set[str]]:
     """
     Takes a directory of potential data-files as a parameter. Accepts command-line argumnets for filename and for columns or without arguments, starts a simple command-line UI to choose the filename and columns.
 
+    With the flag for streaming, csv- and json-lines-files are only previewed for their columns, to be read a chunk at a time later.
+
     Returns:
-        * A dataframe read from the chosen file
+        * A dataframe read from the chosen file (its first rows, if streaming)
         * A set of chosen column-names
+        * The chosen filename
+        * Whether the file is to be streamed
     """
     filenames = os.listdir(data_dir)
 
-    filename, chosen_columns = _arg_parse()
+    filename, chosen_columns, stream = _arg_parse()
 
     if filename not in filenames:
         for i, filename in enumerate(filenames):
@@ -60,9 +100,10 @@ def read_data(data_dir: str) -> Union[pd.DataFrame, Set[str]]:
         try:
             filename = filenames[int(file_choice)]
         except (ValueError, IndexError):
-            return pd.DataFrame(), set()
+            return pd.DataFrame(), set(), "", False
 
-    dataframe, columns = _get_data(data_dir, filename)
+    stream = stream and _get_file_suffix(filename) in STREAMABLE_SUFFIXES
+    dataframe, columns = _get_data(data_dir, filename, PREVIEW_ROWS if stream else None)
 
     if not chosen_columns.issubset(columns):
         print("-------------------")
@@ -77,7 +118,7 @@ def read_data(data_dir: str) -> Union[pd.DataFrame, Set[str]]:
         except (ValueError, IndexError):
             chosen_columns = set()
 
-    return dataframe, chosen_columns, filename
+    return dataframe, chosen_columns, filename, stream
 
 
 if __name__ == "__main__":
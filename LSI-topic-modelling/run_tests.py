@@ -0,0 +1,7 @@
+import unittest
+
+from unittests import *
+
+## guarded, since the preprocessing worker-processes import the main module
+if __name__ == "__main__":
+    unittest.main()
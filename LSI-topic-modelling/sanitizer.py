@@ -1,123 +1,363 @@
 import re
 import os
-import en_core_web_sm
-import de_core_news_sm
-import fr_core_news_sm
-import xx_ent_wiki_sm
+import json
+import hashlib
+import importlib
+import importlib.util
 import langdetect
 import pandas as pd
-import numpy as np
 from time import perf_counter
-from functools import partial
-from multiprocessing import cpu_count, Pool
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
+from multiprocessing import Pool
 
-from config.config import ClientConfig, AnalyzerConfig
-from misc.data_reader import read_data, _get_file_suffix
+from config.config import ClientConfig, AnalyzerConfig, SanitizerConfig
+from misc.data_reader import read_data, iter_rows
 
-nlp_en = en_core_web_sm.load()
-nlp_de = de_core_news_sm.load()
-nlp_fr = fr_core_news_sm.load()
-nlp_mult = xx_ent_wiki_sm.load()
+# Entity-labels of person names, "PER" in the German and multilingual models
+PERSON_LABELS = {"PERSON", "PER"}
+RETRACTED = "--retracted--"
 
-nlp = {"en": nlp_en, "de": nlp_de, "fr": nlp_fr}
+# A fixed seed makes langdetect return the same language for a text on every run
+langdetect.DetectorFactory.seed = SanitizerConfig.LANGDETECT_SEED
 
-cores = cpu_count() #Number of CPU cores on your system
-partitions = cores #Define as many partitions as you want
- 
 
-def parallelize(data, func):
-    data_split = np.array_split(data, partitions)
-    pool = Pool(cores)
-    data = pd.concat(pool.map(func, data_split))
-    pool.close()
-    pool.join()
-    return data
 
+class ModelRegistry:
+    """
+    Loads the spaCy-pipeline of a language the first time it is needed, and keeps at most 'max_loaded' of them,
+    dropping the least recently used one first.
+    A language of AnalyzerConfig.ISOCODE_LANGUAGE_MAP uses its package in SanitizerConfig.SPACY_MODELS, or
+    '<ISO-code>_core_news_sm' if not listed there. Languages without an installed package use the multilingual one.
+    """
+    def __init__(self, max_loaded: int = SanitizerConfig.MAX_LOADED_MODELS):
+        self.max_loaded = max_loaded
+        self.packages = {}
+        self.models = OrderedDict()
 
-def run_on_subset(func, data_subset):
-    return data_subset.map(func)
 
+    def package(self, language: str) -> str:
+        """
+        Returns the name of the spaCy-package used for a language ISO-code
+        """
+        if language in self.packages:
+            return self.packages[language]
 
-def parallelize_on_rows(data, func):
-    return parallelize(data, partial(run_on_subset, func))
+        package = SanitizerConfig.MULTILINGUAL_MODEL
+        if language in AnalyzerConfig.ISOCODE_LANGUAGE_MAP:
+            _package = SanitizerConfig.SPACY_MODELS.get(language, f"{language}_core_news_sm")
+            if importlib.util.find_spec(_package) is not None:
+                package = _package
 
+        self.packages[language] = package
+        return package
 
-class Sanitizer:
-    def __init__(self, data: pd.DataFrame, columns_to_sanitize: set, filename: str):
-        self.columns = data.columns.values
 
-        for column in columns_to_sanitize:
-            if column not in self.columns:
-                print(f"Column '{column}' destined for sanitizing, not found in data. Dropping from targets.")
-                columns_to_sanitize.remove(column)
+    def get(self, language: str):
+        """
+        Returns the spaCy-pipeline for a language ISO-code
+        """
+        package = self.package(language)
+        if package in self.models:
+            self.models.move_to_end(package)
+            return self.models[package]
 
-        self.language_column = "language"
-        self.targets = columns_to_sanitize
-        self.dataframe = data
+        model = importlib.import_module(package).load()
+        self.models[package] = model
+        if len(self.models) > self.max_loaded:
+            self.models.popitem(last=False)
 
-        self._sanitize()
-        _filename = filename[:filename.rfind(".")].replace(" ", "_") + ".json"
-        path = os.path.join(ClientConfig.SANITIZED_FILES_DIRECTORY, _filename)
-        self._dump_as_json(path)
+        return model
+
+
+# spaCy-pipelines of this process, every worker-process loads its own on demand
+models = ModelRegistry()
+
+
+def filter_email_addresses(text: str) -> str:
+    """
+    Substitute email-addresses with 'xxx@email.zz'
+    """
+    return re.sub(r"\S*@\S*\s?", 'xxx@email.zz ', str(text))
+
+
+def langdetect_wrapped(text: str) -> str:
+    """
+    Wrapped langdetect to handle empty text-strings.
+
+    Returns a string of language ISO-codes
+    """
+    try:
+        return langdetect.detect(str(text))
+    except langdetect.lang_detect_exception.LangDetectException:
+        return ""
+
+
+def detect_language(text: str) -> str:
+    """
+    Detects the language of a text, defaulting to English for languages without an analyzer.
+
+    Returns a language ISO-code
+    """
+    language = langdetect_wrapped(text)
+    if language not in AnalyzerConfig.ISOCODE_LANGUAGE_MAP:
+        language = SanitizerConfig.DEFAULT_LANGUAGE
+
+    return language
+
+
+def language_key(text: str) -> bytes:
+    """
+    Hashes a text for the language-cache. Texts differing only by case, numbers or whitespace, like tickets from
+    the same template, share a key.
+    """
+    normalized = " ".join(re.sub(r"\d+", "0", str(text).lower()).split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+def is_short(text: str) -> bool:
+    # Too short for langdetect to tell reliably, the fast path gives these the language of their row instead
+    return SanitizerConfig.LANGUAGE_FAST_PATH and len(str(text).strip()) < SanitizerConfig.SHORT_TEXT_LENGTH
 
 
-    def _filter_email_addresses(self, text: str) -> str:
+def redact_persons(doc) -> str:
+    """
+    Replaces the person names found in a parsed text with '--retracted--', using the character offsets of the entities
+    """
+    parts = []
+    end = 0
+    for ent in doc.ents:
+        if ent.label_ in PERSON_LABELS:
+            parts.append(doc.text[end:ent.start_char])
+            parts.append(RETRACTED)
+            end = ent.end_char
+    parts.append(doc.text[end:])
+
+    return "".join(parts)
+
+
+def sanitize_texts(texts: list, languages: list) -> list:
+    """
+    Attempts to find person names in texts and replace them with '--retracted--'. The texts are grouped by language
+    and parsed in batches, with only the entity recognizer of the language's spaCy-pipeline enabled.
+
+    Returns a list of sanitized texts, in the order of 'texts'
+    """
+    filtered = [filter_email_addresses(text) for text in texts]
+
+    positions = defaultdict(list)
+    for i, language in enumerate(languages):
+        positions[language].append(i)
+
+    sanitized = [None] * len(filtered)
+    for language, indexes in positions.items():
+        model = models.get(language)
+        disabled = [name for name in model.pipe_names if name != "ner"]
+        docs = model.pipe((filtered[i] for i in indexes), batch_size=SanitizerConfig.NER_BATCH_SIZE, disable=disabled)
+
+        for i, doc in zip(indexes, docs):
+            sanitized[i] = redact_persons(doc)
+
+    return sanitized
+
+
+# Tasks run in a worker-process, and report it with the time taken for the throughput counters
+def _sanitize_task(task: tuple) -> tuple:
+    start = perf_counter()
+    sanitized = sanitize_texts(*task)
+    return sanitized, os.getpid(), perf_counter() - start
+
+
+def _detect_task(texts: list) -> tuple:
+    start = perf_counter()
+    languages = [detect_language(text) for text in texts]
+    return languages, os.getpid(), perf_counter() - start
+
+
+class SanitizerPool:
+    """
+    A pool of worker-processes, each loading the spaCy-pipelines it needs once. Reused for every column and file
+    sanitized, and sent only slices of texts to sanitize.
+    Keeps the detected languages in a cache shared by the workers, and counts the texts and the time spent on them per worker.
+    """
+    def __init__(self, processes: int = SanitizerConfig.WORKERS):
+        self.pool = Pool(processes)
+        self.language_cache = OrderedDict()
+        self.counters = defaultdict(lambda: {"texts": 0, "detected": 0, "seconds": 0.0})
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+    def _slices(self, items: list) -> list:
+        size = SanitizerConfig.TASK_SIZE
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+    def _detect(self, texts: dict) -> dict:
         """
-        Substitute email-addresses with 'xxx@email.zz'
+        Detects the languages of texts in slices over the worker-processes, and caches them.
+
+        Params:
+            * texts: Texts to detect by their language-keys.
+
+        Returns the detected languages by the language-keys
         """
-        return re.sub(r"\S*@\S*\s?", 'xxx@email.zz ', str(text))
+        keys = list(texts)
+        languages = []
+        for _languages, pid, seconds in self.pool.imap(_detect_task, self._slices(list(texts.values()))):
+            languages.extend(_languages)
+            self.counters[pid]["detected"] += len(_languages)
+            self.counters[pid]["seconds"] += seconds
 
+        detected = dict(zip(keys, languages))
+        self.language_cache.update(detected)
+        while len(self.language_cache) > SanitizerConfig.LANGUAGE_CACHE_SIZE:
+            self.language_cache.popitem(last=False)
 
-    def _langdetect_wrapped(self, text: str) -> str:
+        return detected
+
+
+    def identify_languages(self, columns: list) -> tuple:
         """
-        Wrapped langdetect to handle empty text-strings.
+        Identifies the language of each row once, from the texts of its columns. Every distinct text is detected once,
+        others are looked up from the cache. The language of a row is the one with the most text in the row.
+        With SanitizerConfig.LANGUAGE_FAST_PATH, texts shorter than SanitizerConfig.SHORT_TEXT_LENGTH are not
+        detected, but take the language of their row.
+
+        Params:
+            * columns: A list of texts per column, in the order of the rows.
 
-        Returns a string of language ISO-codes
+        Returns a list of the languages of the rows, and a list of the languages of the texts per column
         """
-        try:
-            return langdetect.detect(str(text))
-        except langdetect.lang_detect_exception.LangDetectException:
-            return ""
+        keys = [[None if is_short(text) else language_key(text) for text in texts] for texts in columns]
+
+        found, missing = {}, {}
+        for texts, _keys in zip(columns, keys):
+            for text, key in zip(texts, _keys):
+                if key is None or key in found or key in missing:
+                    continue
+                if key in self.language_cache:
+                    self.language_cache.move_to_end(key)
+                    found[key] = self.language_cache[key]
+                else:
+                    missing[key] = text
+
+        if missing:
+            found.update(self._detect(missing))
+
+        row_languages = []
+        column_languages = [[] for _ in columns]
+        for i in range(len(columns[0]) if columns else 0):
+            weights = defaultdict(int)
+            for texts, _keys in zip(columns, keys):
+                if _keys[i] is not None:
+                    weights[found[_keys[i]]] += len(str(texts[i]))
+
+            row_language = max(weights, key=weights.get) if weights else SanitizerConfig.DEFAULT_LANGUAGE
+            row_languages.append(row_language)
+            for languages, _keys in zip(column_languages, keys):
+                languages.append(row_language if _keys[i] is None else found[_keys[i]])
+
+        return row_languages, column_languages
+
+
+    def sanitize(self, texts: list, languages: list) -> list:
+        """
+        Sanitizes texts of known languages in slices of SanitizerConfig.TASK_SIZE, spread over the worker-processes.
+
+        Returns a list of sanitized texts, in the order of 'texts'
+        """
+        tasks = zip(self._slices(texts), self._slices(languages))
 
+        sanitized = []
+        for _sanitized, pid, seconds in self.pool.imap(_sanitize_task, tasks):
+            sanitized.extend(_sanitized)
+            self.counters[pid]["texts"] += len(_sanitized)
+            self.counters[pid]["seconds"] += seconds
 
-    def _sanitize_entry(self, text: str) -> str:
+        return sanitized
+
+
+    def report(self) -> None:
         """
-        Attempts to find person names in text and replace them with '--retracted--' 
+        Prints the throughput of each worker-process
         """
-        language = self._langdetect_wrapped(text)
-        try:
-            AnalyzerConfig.ISOCODE_LANGUAGE_MAP[language]
-        except KeyError:
-            language = "en"
-            
-        text = self._filter_email_addresses(text)
+        for pid, counter in sorted(self.counters.items()):
+            rate = (counter["texts"] + counter["detected"]) / counter["seconds"] if counter["seconds"] else 0.0
+            print(f"Worker {pid}: {counter['texts']} texts sanitized and {counter['detected']} languages detected "
+                  f"in {round(counter['seconds'], 2)} seconds, {round(rate, 1)} texts/s")
 
-        try:
-            doc = nlp[language](text)
-        except KeyError:
-            doc = nlp_mult(text)
-        
-        _text = doc.text
-        for ent in doc.ents:
-            if ent.label_ == "PERSON":
-                escaped = re.escape(ent.text)
-                _text = re.sub(escaped, "--retracted--", _text)
 
-        return {"text": _text, "language": language}
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+
+class Sanitizer:
+    def __init__(self, data: pd.DataFrame, columns_to_sanitize: set, filename: str, pool: SanitizerPool = None):
+        self.columns = data.columns.values
+
+        self.language_column = "language"
+        self.targets = self._check_targets(columns_to_sanitize)
+        self.dataframe = data
+
+        with self._using(pool):
+            self._sanitize()
+        _filename = filename[:filename.rfind(".")].replace(" ", "_") + ".json"
+        path = os.path.join(ClientConfig.SANITIZED_FILES_DIRECTORY, _filename)
+        self._dump_as_json(path)
+
+
+    def _check_targets(self, columns_to_sanitize: set) -> set:
+        """
+        Drops the columns not found in the data from the columns to sanitize
+
+        Returns a set of column-names
+        """
+        targets = set(columns_to_sanitize)
+        for column in columns_to_sanitize:
+            if column not in self.columns:
+                print(f"Column '{column}' destined for sanitizing, not found in data. Dropping from targets.")
+                targets.remove(column)
+
+        return targets
+
+
+    @contextmanager
+    def _using(self, pool: SanitizerPool):
+        # Sanitizes with the given pool, or with a pool of its own for just this file
+        if pool is not None:
+            self.pool = pool
+            yield
+            return
+
+        with SanitizerPool() as self.pool:
+            yield
 
 
     def _sanitize(self) -> None:
         """
-        Runs sanitizing per target-column in 'self.targets'
+        Identifies the languages of the rows, then runs sanitizing per target-column in 'self.targets'.
+        The language of each row is saved in the language-column, and the language of each text in '<column>_language'.
         """
-        for column in self.targets:
-            data = parallelize_on_rows(self.dataframe[column], self._sanitize_entry)
+        targets = sorted(self.targets)
+        if not targets:
+            # Nothing to sanitize, the data is saved as it is
+            return
 
-            texts = [entry["text"] for entry in data]
-            languages = [entry["language"] for entry in data]
+        row_languages, column_languages = self.pool.identify_languages([self.dataframe[column].tolist() for column in targets])
 
-            self.dataframe[column] = texts
-            self.dataframe[self.language_column] = languages
+        for column, languages in zip(targets, column_languages):
+            self.dataframe[column] = self.pool.sanitize(self.dataframe[column].tolist(), languages)
+            self.dataframe[f"{column}_{self.language_column}"] = languages
+
+        self.dataframe[self.language_column] = row_languages
 
 
     def _dump_as_json(self, path: str) -> None:
@@ -128,13 +368,111 @@ class Sanitizer:
         self.dataframe.to_json(path)
 
 
+class StreamingSanitizer(Sanitizer):
+    """
+    Sanitizes a csv- or json-lines-file a chunk of rows at a time, appending each sanitized chunk to a json-lines-file.
+    The completed chunks are recorded in a progress-file next to the output, so that an interrupted run resumes after
+    the last one. The progress-file is removed once the whole file is sanitized.
+    """
+    def __init__(self, path: str, columns_to_sanitize: set, filename: str, chunksize: int = SanitizerConfig.STREAM_CHUNK_SIZE,
+                 pool: SanitizerPool = None):
+        self.language_column = "language"
+
+        _filename = filename[:filename.rfind(".")].replace(" ", "_") + ".jsonl"
+        output_path = os.path.join(ClientConfig.SANITIZED_FILES_DIRECTORY, _filename)
+        progress_path = output_path + ".progress"
+
+        # Progress is only resumed from a run on the same file, columns and chunks
+        run = {"path": os.path.abspath(path), "columns": sorted(columns_to_sanitize), "chunksize": chunksize}
+        progress = self._read_progress(progress_path)
+        output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        if progress.get("run") != run or progress["size"] > output_size:
+            progress = {"run": run, "chunks": 0, "size": 0}
+        elif progress["chunks"]:
+            print(f"Resuming after {progress['chunks']} completed chunks")
+
+        # Anything after the last completed chunk was written by an interrupted one
+        with open(output_path, "ab") as f:
+            f.truncate(progress["size"])
+
+        # Set before the first chunk, so that a file without rows is saved as an empty one
+        self.columns = []
+        self.targets = set()
+        self.dataframe = pd.DataFrame()
+
+        rows = 0
+        with self._using(pool):
+            for i, chunk in enumerate(iter_rows(path, chunksize)):
+                rows += len(chunk)
+                if i == 0:
+                    self.columns = chunk.columns.values
+                    self.targets = self._check_targets(columns_to_sanitize)
+
+                if i < progress["chunks"]:
+                    continue
+
+                self.dataframe = chunk
+
+                self._sanitize()
+                progress["size"] = self._append_as_json_lines(output_path)
+                progress["chunks"] = i + 1
+                self._save_progress(progress_path, progress)
+                print(f"Sanitized chunk {i + 1}, {rows} rows in total")
+
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+
+        # The columns of the last sanitized chunk include the added language-columns
+        columns = self.dataframe.columns.values if len(self.dataframe.columns) else self.columns
+        print(f"Saved columns {columns}, with {rows} entries to {output_path}")
+
+
+    def _read_progress(self, path: str) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+    def _save_progress(self, path: str, progress: dict) -> None:
+        # Written to a temporary file first, so that a crash never leaves a partial progress-file
+        with open(path + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(path + ".tmp", path)
+
+
+    def _append_as_json_lines(self, path: str) -> int:
+        """
+        Appends the dataframe to a json-lines-file, and flushes it to disk before its progress is recorded
+
+        Returns the size of the file in bytes
+        """
+        lines = self.dataframe.to_json(orient="records", lines=True, force_ascii=False)
+        if not lines.endswith("\n"):
+            lines += "\n"
+
+        with open(path, "ab") as f:
+            f.write(lines.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+
 if __name__ == "__main__":
     start = perf_counter()
 
-    df, columns, filename = read_data(ClientConfig.DATA_DIRECTORY)
+    df, columns, filename, stream = read_data(ClientConfig.DATA_DIRECTORY)
     print(f"Sanitizing data-columns: '{columns}'")
 
-    # Sanitizes and dumps the data as a new json-file to project root
-    _ = Sanitizer(df, columns, filename)
+    with SanitizerPool() as pool:
+        if stream:
+            # Sanitizes the file a chunk at a time, appending to a new json-lines-file in the training_data-folder
+            _ = StreamingSanitizer(os.path.join(ClientConfig.DATA_DIRECTORY, filename), columns, filename, pool=pool)
+        else:
+            # Sanitizes and dumps the data as a new json-file to project root
+            _ = Sanitizer(df, columns, filename, pool=pool)
+
+        pool.report()
     
     print(f"Took {round(perf_counter() - start, 2)} seconds")
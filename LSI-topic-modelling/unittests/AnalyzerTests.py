@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+similarity analyzer tests
+
+the analyzers are set up for German, which is stemmed without the WordNet-data
+"""
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from config.config import AnalyzerConfig
+from analysis.similarity_analyzer import SimilarityAnalyzer
+
+
+def make_documents(num_documents, seed=0):
+    """
+    documents with frequent words, words appearing only once, and entries filtered out as too short
+    """
+
+    rng = random.Random(seed)
+    words = ["drucker", "netzwerk", "passwort", "kaputt", "langsam", "der", "und"] + ["wort{}".format(i) for i in range(300)]
+    documents = [" ".join(rng.choice(words) for _ in range(rng.randint(0, 12))) for _ in range(num_documents)]
+    return documents + ["", "x", None]
+
+
+class PreprocessTest(unittest.TestCase):
+    """
+    Test that chunked preprocessing returns the same texts as preprocessing every document at once
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class TestConfig(AnalyzerConfig):
+            MODEL_DIRECTORY = self.tmp_dir
+            TRAINING_CHUNK_SIZE = 37
+
+        self.config = TestConfig
+        self.analyzer = SimilarityAnalyzer(("de", "title", "test"), TestConfig)
+        self.documents = make_documents(500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def preprocess_chunks(self, workers):
+        self.config.PREPROCESS_WORKERS = workers
+        spill_directory = os.path.join(self.tmp_dir, "tokens")
+        return [text for chunk in self.analyzer._preprocess_chunks(iter(self.documents), spill_directory) for text in chunk]
+
+    def test_serial(self):
+        """
+        ensure chunks preprocessed in this process match the in-memory preprocessing
+        """
+
+        self.assertEqual(self.preprocess_chunks(1), self.analyzer._preprocess(self.documents))
+
+    def test_parallel(self):
+        """
+        ensure chunks preprocessed in worker-processes match the in-memory preprocessing
+        """
+
+        self.assertEqual(self.preprocess_chunks(2), self.analyzer._preprocess(self.documents))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "tokens")))
+
+
+class QueryTest(unittest.TestCase):
+    """
+    Test the results of a single query
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class TestConfig(AnalyzerConfig):
+            MODEL_DIRECTORY = self.tmp_dir
+            PREPROCESS_WORKERS = 1
+
+        self.analyzer = SimilarityAnalyzer(("de", "title", "test"), TestConfig)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_query(self):
+        """
+        ensure every document is returned, sorted by descending similarity, and an untrained analyzer returns its errors
+        """
+
+        self.assertEqual(self.analyzer.run_query("drucker kaputt"), self.analyzer.errors)
+
+        self.analyzer.train_with(make_documents(200))
+        sims = self.analyzer.similarities("drucker kaputt")
+        results = self.analyzer.run_query("drucker kaputt")
+        self.assertEqual(sorted(document_id for document_id, _ in results), list(range(len(sims))))
+        self.assertEqual([similarity for _, similarity in results], sorted(sims.tolist(), reverse=True))
+
+
+class ANNTest(unittest.TestCase):
+    """
+    Test an analyzer set to use an ivf-index
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class TestConfig(AnalyzerConfig):
+            MODEL_DIRECTORY = self.tmp_dir
+            PREPROCESS_WORKERS = 1
+            INDEX_BACKENDS = {}
+
+        self.config = TestConfig
+        self.documents = make_documents(300)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_missing_ann(self):
+        """
+        ensure a version without an ivf-index is searched exactly, and the next update builds one without modifying it
+        """
+
+        SimilarityAnalyzer(("de", "title", "test"), self.config).train_with(self.documents)
+        self.config.INDEX_BACKENDS = {"de_title_test": "ivf"}
+        analyzer = SimilarityAnalyzer(("de", "title", "test"), self.config)
+        self.assertIsNone(analyzer.artifacts.ann)
+        self.assertIsNone(analyzer.get_state()["recall_at_k"])
+        trained = analyzer.artifacts.directory
+
+        analyzer.update_model(["drucker kaputt"])
+        self.assertIsNotNone(analyzer.artifacts.ann)
+        self.assertTrue(0 < analyzer.get_state()["recall_at_k"] <= 1)
+        self.assertFalse(os.path.exists(os.path.join(trained, "index.ivf")))
+
+
+class VersionTest(unittest.TestCase):
+    """
+    Test that trained and updated versions are published through the manifest, and that a loaded version keeps serving queries
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class TestConfig(AnalyzerConfig):
+            MODEL_DIRECTORY = self.tmp_dir
+            TRAINING_CHUNK_SIZE = 37
+            PREPROCESS_WORKERS = 1
+            KEEP_VERSIONS = 2
+
+        self.config = TestConfig
+        self.documents = make_documents(300)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def analyzer(self):
+        return SimilarityAnalyzer(("de", "title", "test"), self.config)
+
+    def manifest(self, analyzer):
+        with open(analyzer.manifest_filename) as f:
+            return json.load(f)
+
+    def test_untrained(self):
+        """
+        ensure an analyzer without a trained version reports an error, and can not be updated
+        """
+
+        analyzer = self.analyzer()
+        self.assertEqual(analyzer.get_state()["state"], "NOK")
+        self.assertIsNone(analyzer.get_state()["version"])
+        self.assertRaises(RuntimeError, analyzer.update_model, ["drucker kaputt"])
+        self.assertEqual(os.listdir(analyzer.directory), ["manifest.lock"])
+
+    def test_publish(self):
+        """
+        ensure training and updating publish new versions, and only the last KEEP_VERSIONS are kept
+        """
+
+        analyzer = self.analyzer()
+        analyzer.train_with(self.documents)
+        first = analyzer.get_state()["version"]
+        self.assertEqual(analyzer.get_state()["state"], "OK")
+        self.assertEqual(self.manifest(analyzer)["current"], first)
+        num_documents = len(analyzer.artifacts.index)
+
+        result = analyzer.update_model(["drucker kaputt", "netzwerk langsam"])
+        self.assertEqual(result["document_ids"], [num_documents, num_documents + 1])
+        second = analyzer.get_state()["version"]
+        self.assertNotEqual(second, first)
+        self.assertEqual(len(analyzer.artifacts.index), num_documents + 2)
+
+        analyzer.train_with(self.documents[:100])
+        third = analyzer.get_state()["version"]
+        self.assertEqual(self.manifest(analyzer)["versions"], [second, third])
+        self.assertFalse(os.path.exists(os.path.join(analyzer.directory, first)))
+        self.assertTrue(os.path.exists(os.path.join(analyzer.directory, second)))
+
+    def test_refresh(self):
+        """
+        ensure another instance switches to a published version, but keeps the loaded one while the new one fails to load
+        """
+
+        trainer = self.analyzer()
+        trainer.train_with(self.documents)
+        server = self.analyzer()
+        old = server.get_state()["version"]
+
+        trainer.train_with(self.documents[:100])
+        new = trainer.get_state()["version"]
+        model_filename = os.path.join(trainer.directory, new, "lsi.model")
+        os.rename(model_filename, model_filename + ".bak")
+        self.assertFalse(server.refresh())
+        self.assertEqual(server.get_state()["state"], "OK")
+        self.assertEqual(server.get_state()["version"], old)
+
+        os.rename(model_filename + ".bak", model_filename)
+        self.assertTrue(server.refresh())
+        self.assertEqual(server.get_state()["version"], new)
+        self.assertFalse(server.refresh())
+
+    def test_failed_training(self):
+        """
+        ensure a failed training leaves no staging-directory behind, and keeps the current version
+        """
+
+        analyzer = self.analyzer()
+        analyzer.train_with(self.documents)
+        version = analyzer.get_state()["version"]
+
+        with mock.patch.object(analyzer, "_build", side_effect=MemoryError()):
+            self.assertRaises(MemoryError, analyzer.train_with, self.documents)
+        self.assertTrue(os.path.isdir(os.path.join(analyzer.directory, version)))
+        self.assertFalse([name for name in os.listdir(analyzer.directory) if name.startswith(".staging-")])
+        self.assertEqual(self.manifest(analyzer)["current"], version)
+
+        ## left by a process that died while training
+        os.mkdir(os.path.join(analyzer.directory, ".staging-crashed"))
+        analyzer.update_model(["drucker kaputt"])
+        self.assertFalse([name for name in os.listdir(analyzer.directory) if name.startswith(".staging-")])
+
+
+if __name__ == '__main__':
+    unittest.main()
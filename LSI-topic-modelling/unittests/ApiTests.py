@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+api tests
+
+the requests are made with flask's test client, against analyzers trained into a temporary model directory
+"""
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import app
+from config.config import AnalyzerConfig
+from AnalyzerTests import make_documents
+
+
+class ApiTest(unittest.TestCase):
+    """
+    Test the query endpoints and the health-check
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        ## the analyzers found at startup are loaded before these are swapped out
+        app.ready.wait()
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.config = mock.patch.multiple(AnalyzerConfig, MODEL_DIRECTORY=cls.tmp_dir, PREPROCESS_WORKERS=1, QUERY_BATCH_SIZE=2)
+        cls.config.start()
+        cls.analyzers = dict(app.analyzers)
+        app.analyzers.clear()
+
+        cls.client = app.app.test_client()
+        data = {"keys": ["title", "body"], "language": "de", "dataset": "test",
+                "title": make_documents(200, seed=1), "body": make_documents(200, seed=2)}
+        cls.client.post("/training_data", json=data)
+
+    @classmethod
+    def tearDownClass(cls):
+        app.analyzers.clear()
+        app.analyzers.update(cls.analyzers)
+        cls.config.stop()
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_find_similar_batch(self):
+        """
+        ensure every query of a batch gets the result of querying it alone
+        """
+
+        titles = ["drucker kaputt", "netzwerk langsam", "passwort", "wort1 wort2", ""]
+        bodies = ["drucker und netzwerk", "langsam", "wort3 kaputt", "der", "passwort drucker"]
+        data = {"language": "de", "dataset": "test", "top_n": 3, "log_date": "2020-01-01T00:00:00"}
+
+        r = self.client.post("/find_similar_batch", json=dict(data, title=titles, body=bodies))
+        self.assertEqual(r.status_code, 200)
+        results = r.get_json()["similar"]
+        self.assertEqual(len(results), len(titles))
+
+        for title, body, result in zip(titles, bodies, results):
+            single = self.client.post("/find_similar", json=dict(data, title=title, body=body)).get_json()["similar"]
+            self.assertEqual(len(result), 3)
+            self.assertEqual([r["document_id"] for r in result], [s["document_id"] for s in single])
+            for r, s in zip(result, single):
+                self.assertAlmostEqual(r["similarity_score"], s["similarity_score"], places=5)
+
+    def test_find_similar_batch_fields(self):
+        """
+        ensure query fields that are not lists of the same length are rejected
+        """
+
+        data = {"language": "de", "dataset": "test"}
+        for fields in [{"title": ["a", "b"], "body": ["c"]}, {"title": "a", "body": "c"}, {"title": ["a"], "body": "c"}]:
+            r = self.client.post("/find_similar_batch", json=dict(data, **fields))
+            self.assertEqual(r.status_code, 400)
+
+        r = self.client.post("/find_similar_batch", json=dict(data, title=[], body=[]))
+        self.assertEqual(r.get_json(), {"similar": []})
+
+        r = self.client.post("/find_similar_batch", json=dict(data, language="zz", title=["a"]))
+        self.assertEqual(r.get_json(), {"similar": {"language": "zz not supported"}})
+
+    def test_ready(self):
+        """
+        ensure the analyzers in the model directory are loaded at startup, and the app is ready only after that
+        """
+
+        app.analyzers.clear()
+        app.load_times.clear()
+        app.ready.clear()
+        try:
+            r = self.client.get("/ready")
+            self.assertEqual(r.status_code, 503)
+
+            app.warm_up()
+            r = self.client.get("/ready")
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(sorted(r.get_json()["analyzers"]), ["de_body_test", "de_title_test"])
+            self.assertEqual(sorted(r.get_json()["load_times"]), ["de_body_test", "de_title_test"])
+        finally:
+            app.ready.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+document index tests
+
+the indexes are checked against brute-force scoring of the same vectors
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from analysis.index import top_k, ShardedIndex, IVFIndex
+
+
+def make_vectors(num_vectors, num_features=8, seed=0):
+    """
+    random unit-length vectors
+    """
+
+    vectors = np.random.RandomState(seed).randn(num_vectors, num_features).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def brute_force(queries, vectors, top_n):
+    """
+    document-numbers of the top_n scores of every query, by a full sort
+    """
+
+    return np.argsort(-(queries @ vectors.T), axis=1, kind="stable")[:, :top_n]
+
+
+class TopKTest(unittest.TestCase):
+    """
+    Test the partial sort of scores
+    """
+
+    def test_top_k(self):
+        """
+        ensure the selected scores are the highest ones in descending order
+        """
+
+        scores = np.random.RandomState(0).rand(5, 100).astype(np.float32)
+        for top_n in [1, 10, 99, 100, 200, None]:
+            ids, selected = top_k(scores, top_n)
+            expected = np.argsort(-scores, axis=1, kind="stable")[:, :top_n]
+            np.testing.assert_array_equal(ids, expected)
+            np.testing.assert_array_equal(selected, np.take_along_axis(scores, expected, axis=1))
+
+        self.assertEqual(top_k(scores[0], 3)[0].tolist(), expected[0, :3].tolist())
+        self.assertEqual(top_k(scores, 0)[0].shape, (5, 0))
+
+
+class ShardedIndexTest(unittest.TestCase):
+    """
+    Test the memory-mapped, sharded document index
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vectors = make_vectors(50)
+        self.queries = make_vectors(6, seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_query(self):
+        """
+        ensure the merged top-k of the shards is the exact top-k
+        """
+
+        index = ShardedIndex.build(self.tmp_dir, [self.vectors[:20], self.vectors[20:]], 8, shard_size=7)
+        self.assertEqual(index.shard_rows, [7, 7, 7, 7, 7, 7, 7, 1])
+
+        for top_n in [1, 5, 50]:
+            ids, scores = index.query(self.queries, top_n)
+            np.testing.assert_array_equal(ids, brute_force(self.queries, self.vectors, top_n))
+            np.testing.assert_allclose(scores, np.take_along_axis(self.queries @ self.vectors.T, ids, axis=1), rtol=1e-6)
+
+        np.testing.assert_allclose(index.similarities(self.queries), self.queries @ self.vectors.T, rtol=1e-6)
+        np.testing.assert_allclose(index.similarities(self.queries, start=17), self.queries @ self.vectors[17:].T, rtol=1e-6)
+
+    def test_append(self):
+        """
+        ensure appending fills the last shard before starting new ones, and survives reloading
+        """
+
+        index = ShardedIndex.build(self.tmp_dir, self.vectors[:10], 8, shard_size=7)
+        index.append(self.vectors[10:15])
+        self.assertEqual(index.shard_rows, [7, 7, 1])
+        index.append([self.vectors[15:24], self.vectors[24:]])
+        self.assertEqual(index.shard_rows, [7, 7, 7, 7, 7, 7, 7, 1])
+
+        index = ShardedIndex.load(self.tmp_dir)
+        self.assertEqual(len(index), 50)
+        np.testing.assert_array_equal(np.vstack(index.shards), self.vectors)
+        np.testing.assert_array_equal(index.query(self.queries, 5)[0], brute_force(self.queries, self.vectors, 5))
+
+    def test_empty(self):
+        """
+        ensure an index without documents returns no results
+        """
+
+        index = ShardedIndex.load(ShardedIndex.build(self.tmp_dir, [], 8, shard_size=7).directory)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.query(self.queries, 5)[0].shape, (6, 0))
+        self.assertEqual(index.similarities(self.queries).shape, (6, 0))
+
+
+class IVFIndexTest(unittest.TestCase):
+    """
+    Test the approximate nearest-neighbour index
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vectors = make_vectors(400)
+        self.queries = make_vectors(20, seed=1)
+        self.index = ShardedIndex.build(os.path.join(self.tmp_dir, "index"), self.vectors, 8, shard_size=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def recall(self, ivf, top_n):
+        """
+        recall@k of the ivf-index against brute force
+        """
+
+        exact = brute_force(self.queries, self.vectors, top_n)
+        approximate = ivf.query(self.queries, top_n)[0]
+        return np.mean([len(np.intersect1d(e, a)) / top_n for e, a in zip(exact, approximate)])
+
+    def test_recall(self):
+        """
+        ensure probing every cluster is exact, and the measured recall matches brute force
+        """
+
+        directory = os.path.join(self.tmp_dir, "ivf")
+        ivf = IVFIndex.build(directory, self.index, num_lists=10, num_probes=10)
+        self.assertEqual(self.recall(ivf, 10), 1.0)
+        np.testing.assert_array_equal(ivf.query(self.queries, 10)[0], brute_force(self.queries, self.vectors, 10))
+
+        ivf = IVFIndex.build(directory, self.index, num_lists=10, num_probes=3)
+        self.assertTrue(0 < self.recall(ivf, 10) <= 1)
+        self.assertAlmostEqual(ivf.recall_at_k(self.queries, 10), self.recall(ivf, 10))
+        self.assertTrue(0 < ivf.meta["recall_at_k"] <= 1)
+
+    def test_appended(self):
+        """
+        ensure documents added after the build are found
+        """
+
+        ivf = IVFIndex.build(os.path.join(self.tmp_dir, "ivf"), self.index, num_lists=10, num_probes=1)
+        self.index.append(self.queries)
+        ids, scores = ivf.query(self.queries, 1)
+        np.testing.assert_array_equal(ids[:, 0], np.arange(400, 420))
+        np.testing.assert_allclose(scores[:, 0], 1, rtol=1e-6)
+
+    def test_small_sample(self):
+        """
+        ensure the clusters are limited to the sampled documents
+        """
+
+        ivf = IVFIndex.build(os.path.join(self.tmp_dir, "ivf"), self.index, num_lists=50, training_sample=5)
+        self.assertEqual(ivf.meta["num_lists"], 5)
+        self.assertEqual(ivf.query(self.queries, 3)[0].shape, (20, 3))
+
+    def test_empty(self):
+        """
+        ensure an empty index can be clustered and queried
+        """
+
+        index = ShardedIndex.build(os.path.join(self.tmp_dir, "empty"), [], 8, shard_size=64)
+        ivf = IVFIndex.build(os.path.join(self.tmp_dir, "ivf"), index)
+        self.assertEqual(ivf.meta["num_lists"], 0)
+        self.assertEqual(ivf.query(self.queries, 3)[0].shape, (20, 0))
+        self.assertEqual(ivf.similarities(self.queries).shape, (20, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
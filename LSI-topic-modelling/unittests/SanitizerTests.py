@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+sanitizer tests
+
+only cases that need no spaCy-model are covered here
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import pandas as pd
+
+import sanitizer
+from config.config import ClientConfig
+
+
+class SanitizerTest(unittest.TestCase):
+    """
+    Test the Sanitizer and its worker-pool
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sanitized_files_directory = ClientConfig.SANITIZED_FILES_DIRECTORY
+        ClientConfig.SANITIZED_FILES_DIRECTORY = self.tmp_dir
+        self.pool = sanitizer.SanitizerPool(1)
+
+    def tearDown(self):
+        self.pool.close()
+        ClientConfig.SANITIZED_FILES_DIRECTORY = self.sanitized_files_directory
+        shutil.rmtree(self.tmp_dir)
+
+    def test_no_targets(self):
+        """
+        ensure data without columns to sanitize is saved unchanged
+        """
+
+        df = pd.DataFrame({'id':[1,2,3],'title':["a","b","c"]})
+        for columns in [set(), {"missing"}]:
+            result = sanitizer.Sanitizer(df.copy(), columns, "tickets.csv", pool=self.pool).dataframe
+            pd.testing.assert_frame_equal(result, df)
+            self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "tickets.json")))
+
+    def test_identify_languages_no_columns(self):
+        """
+        ensure identifying languages of no columns returns no languages
+        """
+
+        self.assertEqual(self.pool.identify_languages([]), ([], []))
+
+    def test_resume(self):
+        """
+        ensure a streamed run interrupted mid-chunk resumes after the last completed chunk, without duplicate or partial rows
+        """
+
+        df = pd.DataFrame({'id':list(range(10)),'title':["title {}".format(i) for i in range(10)]})
+        path = os.path.join(self.tmp_dir, "tickets.csv")
+        df.to_csv(path, sep=";", index=False)
+        output_path = os.path.join(self.tmp_dir, "tickets.jsonl")
+
+        append = sanitizer.StreamingSanitizer._append_as_json_lines
+        def interrupted(instance, path):
+            ## the third chunk is written only partly before the crash
+            if instance.dataframe["id"].iloc[0] == 6:
+                with open(path, "a") as f:
+                    f.write('{"id":6,"ti')
+                raise KeyboardInterrupt()
+            return append(instance, path)
+
+        with mock.patch.object(sanitizer.StreamingSanitizer, "_append_as_json_lines", interrupted):
+            self.assertRaises(KeyboardInterrupt, sanitizer.StreamingSanitizer, path, set(), "tickets.csv", chunksize=3, pool=self.pool)
+        self.assertTrue(os.path.exists(output_path + ".progress"))
+
+        with mock.patch.object(sanitizer.StreamingSanitizer, "_sanitize") as sanitize:
+            sanitizer.StreamingSanitizer(path, set(), "tickets.csv", chunksize=3, pool=self.pool)
+            self.assertEqual(sanitize.call_count, 2)
+
+        pd.testing.assert_frame_equal(pd.read_json(output_path, lines=True), df)
+        self.assertFalse(os.path.exists(output_path + ".progress"))
+
+    def test_stream_empty(self):
+        """
+        ensure streaming a file without rows saves an empty file
+        """
+
+        path = os.path.join(self.tmp_dir, "export.jsonl")
+        open(path, "w").close()
+        output_path = os.path.join(self.tmp_dir, "tickets.jsonl")
+        streamed = sanitizer.StreamingSanitizer(path, {"title"}, "tickets.csv", chunksize=3, pool=self.pool)
+        self.assertEqual(len(streamed.columns), 0)
+        self.assertEqual(os.path.getsize(output_path), 0)
+        self.assertFalse(os.path.exists(output_path + ".progress"))
+
+
+class RedactTest(unittest.TestCase):
+    """
+    Test redacting person names by the character offsets of the entities, with parsed texts faked without spaCy
+    """
+
+    def make_doc(self, text, entities):
+        ents = []
+        for name, label in entities:
+            start = text.index(name)
+            ents.append(SimpleNamespace(label_=label, start_char=start, end_char=start + len(name)))
+        return SimpleNamespace(text=text, ents=ents)
+
+    def test_redact_persons(self):
+        """
+        ensure only the recognized spans of persons are replaced
+        """
+
+        doc = self.make_doc("Anna Berg called Helsinki about Anna's printer", [("Anna Berg", "PERSON"), ("Helsinki", "GPE")])
+        self.assertEqual(sanitizer.redact_persons(doc), "--retracted-- called Helsinki about Anna's printer")
+
+        doc = self.make_doc("Drucker von Max Muster", [("Max Muster", "PER")])
+        self.assertEqual(sanitizer.redact_persons(doc), "Drucker von --retracted--")
+
+        doc = self.make_doc("Max und Moritz", [("Max", "PER"), ("Moritz", "PER")])
+        self.assertEqual(sanitizer.redact_persons(doc), "--retracted-- und --retracted--")
+        self.assertEqual(sanitizer.redact_persons(self.make_doc("", [])), "")
+
+
+class ModelRegistryTest(unittest.TestCase):
+    """
+    Test loading spaCy-models on demand, with the packages faked without spaCy
+    """
+
+    def setUp(self):
+        self.installed = {"en_core_web_sm", "de_core_news_sm", "fr_core_news_sm", "xx_ent_wiki_sm"}
+        self.loaded = []
+
+    def find_spec(self, package):
+        return SimpleNamespace(name=package) if package in self.installed else None
+
+    def import_module(self, package):
+        def load():
+            self.loaded.append(package)
+            return SimpleNamespace(package=package)
+        return SimpleNamespace(load=load)
+
+    def test_packages(self):
+        """
+        ensure languages without an installed package use the multilingual model
+        """
+
+        registry = sanitizer.ModelRegistry()
+        with mock.patch("importlib.util.find_spec", self.find_spec):
+            self.assertEqual(registry.package("en"), "en_core_web_sm")
+            self.assertEqual(registry.package("de"), "de_core_news_sm")
+            self.assertEqual(registry.package("es"), "xx_ent_wiki_sm")
+            self.assertEqual(registry.package("zz"), "xx_ent_wiki_sm")
+
+    def test_lru(self):
+        """
+        ensure a model is loaded once, and the least recently used one is dropped first
+        """
+
+        registry = sanitizer.ModelRegistry(max_loaded=2)
+        with mock.patch("importlib.util.find_spec", self.find_spec), mock.patch("importlib.import_module", self.import_module):
+            self.assertEqual(registry.get("en").package, "en_core_web_sm")
+            registry.get("de")
+            registry.get("en")
+            self.assertEqual(self.loaded, ["en_core_web_sm", "de_core_news_sm"])
+
+            registry.get("fr")
+            self.assertEqual(list(registry.models), ["en_core_web_sm", "fr_core_news_sm"])
+            registry.get("de")
+            registry.get("fr")
+            self.assertEqual(self.loaded, ["en_core_web_sm", "de_core_news_sm", "fr_core_news_sm", "de_core_news_sm"])
+            self.assertEqual(list(registry.models), ["de_core_news_sm", "fr_core_news_sm"])
+
+
+if __name__ == '__main__':
+    unittest.main()
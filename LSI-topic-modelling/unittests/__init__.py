@@ -0,0 +1,49 @@
+import unittest
+import getopt
+import sys
+import os
+
+## parse inputs
+try:
+    optlist, args = getopt.getopt(sys.argv[1:],'v')
+except getopt.GetoptError:
+    print(getopt.GetoptError)
+    print(sys.argv[0] + "-v")
+    print("... the verbose flag (-v) may be used")
+    sys.exit()
+
+VERBOSE = False
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)))
+
+for o, a in optlist:
+    if o == '-v':
+        VERBOSE = True
+
+## analyzer tests
+from AnalyzerTests import *
+PreprocessTestSuite = unittest.TestLoader().loadTestsFromTestCase(PreprocessTest)
+QueryTestSuite = unittest.TestLoader().loadTestsFromTestCase(QueryTest)
+ANNTestSuite = unittest.TestLoader().loadTestsFromTestCase(ANNTest)
+VersionTestSuite = unittest.TestLoader().loadTestsFromTestCase(VersionTest)
+
+## index tests
+from IndexTests import *
+TopKTestSuite = unittest.TestLoader().loadTestsFromTestCase(TopKTest)
+ShardedIndexTestSuite = unittest.TestLoader().loadTestsFromTestCase(ShardedIndexTest)
+IVFIndexTestSuite = unittest.TestLoader().loadTestsFromTestCase(IVFIndexTest)
+
+## api tests
+from ApiTests import *
+ApiTestSuite = unittest.TestLoader().loadTestsFromTestCase(ApiTest)
+
+## sanitizer tests
+from SanitizerTests import *
+SanitizerTestSuite = unittest.TestLoader().loadTestsFromTestCase(SanitizerTest)
+RedactTestSuite = unittest.TestLoader().loadTestsFromTestCase(RedactTest)
+ModelRegistryTestSuite = unittest.TestLoader().loadTestsFromTestCase(ModelRegistryTest)
+
+MainSuite = unittest.TestSuite([PreprocessTestSuite, QueryTestSuite, ANNTestSuite, VersionTestSuite,
+                                TopKTestSuite, ShardedIndexTestSuite, IVFIndexTestSuite,
+                                ApiTestSuite,
+                                SanitizerTestSuite, RedactTestSuite, ModelRegistryTestSuite])
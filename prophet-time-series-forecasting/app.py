@@ -6,12 +6,22 @@ import re
 import joblib
 import socket
 import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from prophet_model import model_train, model_predict
+from prophet_model import model_train, model_predict, model_predict_batch
 
 app = Flask(__name__)
 
+## training runs one job at a time in the background, job records are kept on disk
+JOB_DIR = os.path.join(".","jobs")
+_train_executor = ThreadPoolExecutor(max_workers=1)
+_job_lock = threading.Lock()
+_current_job = None  ## (future, job record) of the latest job started by this process
+
 @app.route('/running', methods=['GET','POST'])
 def running():
     return jsonify(True)
@@ -52,17 +62,145 @@ def predict():
     result = model_predict(c,y,m,d)
     return(jsonify(result.yhat.values[0]))
 
+@app.route('/predict_batch', methods=['GET','POST'])
+def predict_batch():
+    """
+    predict many dates with a single request
+
+    expects 'queries' (a list of country, year, month and day)
+    and/or 'ranges' (a list of country, start and end date)
+    """
+
+    ## input checking
+    if not request.json:
+        print("ERROR: API (predict_batch): did not receive request data")
+        return jsonify([])
+
+    if 'queries' not in request.json and 'ranges' not in request.json:
+        print("ERROR API (predict_batch): received request, but no queries or ranges found within")
+        return jsonify([])
+
+    query=(request.json)
+    result = model_predict_batch(queries=query.get("queries"),ranges=query.get("ranges"))
+    return(jsonify(result))
+
+def _save_job(job):
+    """
+    write a job record to disk (replaced in one step so readers never see half a record)
+    """
+
+    if not os.path.isdir(JOB_DIR):
+        os.mkdir(JOB_DIR)
+    job_file = os.path.join(JOB_DIR,job['job_id']+".json")
+    with open(job_file+".tmp","w") as f:
+        json.dump(job,f)
+    os.replace(job_file+".tmp",job_file)
+
+def _run_train_job(job):
+    """
+    train the models in the background and keep the job record up to date
+    """
+
+    def progress(country, status, runtime):
+        with _job_lock:
+            job['countries'][country] = {'status':status,'runtime':runtime}
+            _save_job(job)
+
+    time_start = time.time()
+    with _job_lock:
+        job['status'] = "running"
+        _save_job(job)
+
+    try:
+        print("... training model")
+        model_train(warm_start=job['warm_start'],progress=progress)
+        print("... training complete")
+        status, error = "finished", None
+    except Exception as e:
+        print("ERROR API (train): {}".format(e))
+        status, error = "failed", str(e)
+
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    with _job_lock:
+        job['status'] = status
+        job['error'] = error
+        job['runtime'] = "%03d:%02d:%02d"%(h, m, s)
+        _save_job(job)
+
+def _fail_stale_jobs():
+    """
+    mark the jobs left queued or running by a process that is gone (e.g. before a restart) as failed
+    """
+
+    if not os.path.isdir(JOB_DIR):
+        return
+    for job_file in os.listdir(JOB_DIR):
+        if not job_file.endswith(".json"):
+            continue
+        with open(os.path.join(JOB_DIR,job_file)) as f:
+            job = json.load(f)
+        if job['status'] in ["queued","running"] and not _is_alive(job.get('pid')):
+            job['status'] = "failed"
+            job['error'] = "interrupted, the server was restarted"
+            _save_job(job)
+
+def _is_alive(pid):
+    """
+    whether another process with the given id is running
+    (this process has not started any jobs yet, so its own id is from an earlier process)
+    """
+
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+## worker-processes of the training import this module too, but the process that started the job is alive then
+_fail_stale_jobs()
+
 @app.route('/train', methods=['GET','POST'])
 def train():
     """
-    basic predict function for the API
+    start training in the background and return the id of the job
+
+    requests made while a job is queued or running get that job's id
+    instead of starting another one
+    with {"warm_start": true} each fit starts from the parameters of the previously saved model
+    """
+
+    global _current_job
+
+    query = request.get_json(silent=True) or {}
+    warm_start = bool(query.get('warm_start',False)) if isinstance(query,dict) else False
+
+    with _job_lock:
+        if _current_job is None or _current_job[0].done():
+            job = {'job_id':uuid.uuid4().hex,'status':"queued",'created':time.time(),'warm_start':warm_start,
+                   'pid':os.getpid(),'countries':{},'runtime':None,'error':None}
+            _save_job(job)
+            _current_job = (_train_executor.submit(_run_train_job,job),job)
+        job = _current_job[1]
+        return(jsonify({'job_id':job['job_id'],'status':job['status']}))
+
+@app.route('/train/<job_id>', methods=['GET'])
+def train_status(job_id):
+    """
+    status of a training job, with the progress per country and the final runtime
     """
 
-    print("... training model")
-    model_train()
-    print("... training complete")
+    job_file = os.path.join(JOB_DIR,re.sub("\W+","",job_id)+".json")
+    if not os.path.exists(job_file):
+        print("ERROR API (train): job {} not found".format(job_id))
+        return(jsonify({}),404)
 
-    return(jsonify(True))
+    with open(job_file) as f:
+        return(jsonify(json.load(f)))
         
 if __name__ == '__main__':
 
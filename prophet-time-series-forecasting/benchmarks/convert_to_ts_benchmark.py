@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+benchmark the daily aggregation (cslib.convert_to_ts) against the original per-day loop
+
+the cs_train invoices are repeated over consecutive months to scale them up
+
+    ~$ python benchmarks/convert_to_ts_benchmark.py
+    ~$ python benchmarks/convert_to_ts_benchmark.py --factors 10 100 --reference-limit 10
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),"..")))
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),"..","unittests")))
+
+from cslib import fetch_data, convert_to_ts, convert_countries_to_ts
+from CslibTests import convert_to_ts_reference, scale_invoices
+
+def timed(func, *args):
+    time_start = time.time()
+    result = func(*args)
+    return(result, time.time()-time_start)
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--data-dir", default="cs_train", help="directory with invoice json files")
+    ap.add_argument("-f", "--factors", type=int, nargs="+", default=[1, 10, 100], help="scale factors")
+    ap.add_argument("-r", "--reference-limit", type=int, default=10,
+                    help="largest factor that is also timed with the original implementation")
+    args = ap.parse_args()
+
+    df_month = fetch_data(args.data_dir)
+
+    print("{:>7} {:>10} {:>12} {:>12} {:>12} {:>9}".format("factor","rows","reference","all","countries","speedup"))
+    for factor in args.factors:
+        df = scale_invoices(df_month,factor)
+        countries = df['country'].unique()
+
+        _, runtime = timed(convert_to_ts,df)
+        _, runtime_countries = timed(convert_countries_to_ts,df,countries)
+
+        if factor <= args.reference_limit:
+            _, runtime_reference = timed(lambda: [convert_to_ts_reference(df)] + \
+                                         [convert_to_ts_reference(df,country=c) for c in countries])
+            speedup = "{:.1f}x".format(runtime_reference / (runtime + runtime_countries))
+            runtime_reference = "{:.3f}s".format(runtime_reference)
+        else:
+            runtime_reference, speedup = "-", "-"
+
+        print("{:>7} {:>10} {:>12} {:>11.3f}s {:>11.3f}s {:>9}".format(factor, df.shape[0], runtime_reference,
+                                                                     runtime, runtime_countries, speedup))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+benchmark loading invoice json files (cslib.fetch_data and cslib.iter_data)
+
+a synthetic invoice directory is generated from the cs_train invoices
+(one file per month) and every loader runs in a separate process
+so that its peak memory can be reported
+
+    ~$ python benchmarks/fetch_data_benchmark.py --size-gb 2
+    ~$ python benchmarks/fetch_data_benchmark.py --size-gb 0.2 --modes parallel streaming
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),"..")))
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),"..","unittests")))
+
+from cslib import fetch_data, iter_data
+from CslibTests import fetch_data_reference
+
+MODES = ["reference","serial","parallel","streaming"]
+BYTES_PER_ROW = 160
+
+def make_invoices(data_dir, target_dir, size_gb, n_files):
+    """
+    write n_files months of synthetic invoices adding up to roughly size_gb
+    """
+
+    df_base = fetch_data(data_dir)
+    df_base = df_base.drop(columns=['invoice_date'])
+    n_rows = int(size_gb * 1e9 / BYTES_PER_ROW / n_files)
+    rng = np.random.RandomState(42)
+
+    for i in range(n_files):
+        year, month = 2017 + (10+i) // 12, (10+i) % 12 + 1
+        df = df_base.iloc[rng.randint(0,df_base.shape[0],n_rows)].copy()
+        df['year'], df['month'] = str(year), str(month).zfill(2)
+        df['day'] = [str(d).zfill(2) for d in rng.randint(1,29,n_rows)]
+        df['invoice'] = np.where(rng.rand(n_rows) < 0.05,"C","") + rng.randint(400000,600000,n_rows).astype(str)
+        if i % 2:
+            df.rename(columns={'price':'total_price'},inplace=True)
+        df.to_json(os.path.join(target_dir,"invoices-{}-{}.json".format(year,str(month).zfill(2))),orient='records')
+
+def run_mode(mode, target_dir, n_workers):
+    """
+    load the directory with one of the loaders and report time and peak memory
+    """
+
+    time_start = time.time()
+    if mode == "reference":
+        rows = fetch_data_reference(target_dir).shape[0]
+    elif mode == "serial":
+        rows = fetch_data(target_dir,n_workers=1).shape[0]
+    elif mode == "parallel":
+        rows = fetch_data(target_dir,n_workers=n_workers).shape[0]
+    else:
+        rows = 0
+        for df in iter_data(target_dir,n_workers=n_workers):
+            rows += df.shape[0]
+    runtime = time.time() - time_start
+
+    ## ru_maxrss is in kilobytes on linux
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps({'rows':rows,'runtime':runtime,'peak_mb':peak_self,'peak_worker_mb':peak_children}))
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--data-dir", default="cs_train", help="directory with invoice json files")
+    ap.add_argument("-s", "--size-gb", type=float, default=2.0, help="size of the synthetic invoice directory")
+    ap.add_argument("-f", "--files", type=int, default=24, help="number of monthly files")
+    ap.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="worker processes")
+    ap.add_argument("-m", "--modes", nargs="+", default=MODES, choices=MODES)
+    ap.add_argument("--target-dir", default=None, help="keep the synthetic files in this directory")
+    ap.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        run_mode(args.run, args.target_dir, args.workers)
+        sys.exit()
+
+    target_dir = args.target_dir or tempfile.mkdtemp()
+    try:
+        if not os.listdir(target_dir):
+            print("... writing {} GB of synthetic invoices to {}".format(args.size_gb,target_dir))
+            make_invoices(args.data_dir,target_dir,args.size_gb,args.files)
+        size_mb = sum([os.path.getsize(os.path.join(target_dir,f)) for f in os.listdir(target_dir)]) / 2**20
+
+        print("{:>10} {:>11} {:>10} {:>9} {:>10} {:>14}".format("mode","rows","runtime","MB/s","peak MB","peak worker MB"))
+        for mode in args.modes:
+            output = subprocess.run([sys.executable,__file__,"--run",mode,"--target-dir",target_dir,
+                                     "--workers",str(args.workers)],
+                                    stdout=subprocess.PIPE,check=True).stdout.decode()
+            result = json.loads(output.strip().split("\n")[-1])
+            print("{:>10} {:>11} {:>9.1f}s {:>9.1f} {:>10.0f} {:>14.0f}".format(mode,result['rows'],result['runtime'],
+                                                                            size_mb/result['runtime'],
+                                                                            result['peak_mb'],result['peak_worker_mb']))
+    finally:
+        if not args.target_dir:
+            shutil.rmtree(target_dir)
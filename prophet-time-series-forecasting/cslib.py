@@ -9,7 +9,13 @@ import re
 import shutil
 import time
 import pickle
-from collections import defaultdict
+import json
+import uuid
+import fcntl
+import hashlib
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from datetime import datetime
 import numpy as np
 import pandas as pd
@@ -19,10 +25,52 @@ from pandas.plotting import register_matplotlib_converters
 register_matplotlib_converters()
 
 COLORS = ["darkorange","royalblue","slategrey"]
+PREVIOUS_WINDOWS = [7, 14, 28, 70]  #[7, 14, 21, 28, 35, 42, 49, 56, 63, 70]
+CORRECT_COLUMNS = ['country', 'customer_id', 'day', 'invoice', 'month',
+                   'price', 'stream_id', 'times_viewed', 'year']
+COLUMN_NAMES = {'StreamID':'stream_id','TimesViewed':'times_viewed','total_price':'price'}
+TS_COLUMNS = ['purchases','unique_invoices','unique_streams','total_views','revenue']
+TS_DATA_DIR = os.path.join(".","data","cs_train","data")
+TS_MANIFEST = "manifest.json"
+TS_KEEP_VERSIONS = 2  # store versions kept, a reader of the previous one is not cut off by a new write
+HASH_BLOCK_SIZE = 2**20
+
+## manifests of the time-series stores read by this process
+_manifests = {}
+
+## the reading processes are not forked from the caller, which may be a thread of the app (see prophet_model)
+_READ_CONTEXT = get_context("forkserver")
+
+def _read_invoices(file_name):
+    """
+    load one json formatted file and bring it into the common format
+    (used by the worker processes of iter_data)
+    """
+
+    df = pd.read_json(file_name)
+
+    ## ensure the data are formatted with correct columns
+    df.rename(columns=COLUMN_NAMES,inplace=True)
+    if sorted(df.columns.tolist()) != CORRECT_COLUMNS:
+        raise Exception("columns name could not be matched to correct cols")
+    df = df[CORRECT_COLUMNS]
 
-def fetch_data(data_dir):
+    dates = pd.to_datetime(pd.DataFrame({'year':df['year'].astype(int),
+                                         'month':df['month'].astype(int),
+                                         'day':df['day'].astype(int)}))
+    df['invoice_date'] = dates.values.astype('datetime64[D]')
+    df['invoice'] = df['invoice'].astype(str).str.replace("\D+","",regex=True)
+
+    return(df)
+
+
+def iter_data(data_dir, file_names=None, n_workers=None):
     """
-    laod all json formatted files into a dataframe
+    load the json formatted files one by one with a pool of worker processes
+    yields one formatted DataFrame per file (in the order of the files)
+
+    no more than 'n_workers' files are loaded ahead of the consumer
+    so memory stays bounded to a few files rather than the whole history
     """
 
     ## input testing
@@ -31,44 +79,93 @@ def fetch_data(data_dir):
     if not len(os.listdir(data_dir)) > 0:
         raise Exception("specified data dir does not contain any files")
 
-    file_list = [os.path.join(data_dir,f) for f in os.listdir(data_dir) if re.search("\.json",f)]
-    correct_columns = ['country', 'customer_id', 'day', 'invoice', 'month',
-                       'price', 'stream_id', 'times_viewed', 'year']
+    if file_names is None:
+        file_names = _source_files(data_dir)
+    file_list = [os.path.join(data_dir,f) for f in file_names]
+    if n_workers is None:
+        n_workers = min(os.cpu_count() or 1,len(file_list))
 
-    ## read data into a temp structure
-    all_months = {}
-    for file_name in file_list:
-        df = pd.read_json(file_name)
-        all_months[os.path.split(file_name)[-1]] = df
+    if n_workers <= 1:
+        for file_name in file_list:
+            yield _read_invoices(file_name)
+        return
 
-    ## ensure the data are formatted with correct columns
-    for f,df in all_months.items():
-        cols = set(df.columns.tolist())
-        if 'StreamID' in cols:
-             df.rename(columns={'StreamID':'stream_id'},inplace=True)
-        if 'TimesViewed' in cols:
-            df.rename(columns={'TimesViewed':'times_viewed'},inplace=True)
-        if 'total_price' in cols:
-            df.rename(columns={'total_price':'price'},inplace=True)
-
-        cols = df.columns.tolist()
-        if sorted(cols) != correct_columns:
-            raise Exception("columns name could not be matched to correct cols")
+    with ProcessPoolExecutor(max_workers=n_workers,mp_context=_READ_CONTEXT) as executor:
+        pending = deque()
+        for file_name in file_list:
+            pending.append(executor.submit(_read_invoices,file_name))
+            if len(pending) >= n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fetch_data(data_dir, file_names=None, n_workers=None):
+    """
+    laod all json formatted files into a dataframe
+    'file_names' restricts loading to those files in data_dir
+    the files are parsed in parallel (see iter_data)
+    """
 
     ## concat all of the data
-    df = pd.concat(list(all_months.values()),sort=True)
-    years,months,days = df['year'].values,df['month'].values,df['day'].values 
-    dates = ["{}-{}-{}".format(years[i],str(months[i]).zfill(2),str(days[i]).zfill(2)) for i in range(df.shape[0])]
-    df['invoice_date'] = np.array(dates,dtype='datetime64[D]')
-    df['invoice'] = [re.sub("\D+","",i) for i in df['invoice'].values]
-    
-    ## sort by date and reset the index
-    df.sort_values(by='invoice_date',inplace=True)
+    df = pd.concat(list(iter_data(data_dir,file_names=file_names,n_workers=n_workers)))
+
+    ## sort by date (stable, so the rows of a day keep their order) and reset the index
+    df.sort_values(by='invoice_date',inplace=True,kind='mergesort')
     df.reset_index(drop=True,inplace=True)
     
     return(df)
 
 
+def _aggregate_days(df, by=None):
+    """
+    aggregate the invoices of every day (and every value of column 'by')
+    with a single groupby rather than rescanning the data for each day
+    """
+
+    keys = ['invoice_date'] if by is None else [by,'invoice_date']
+    grouped = df.groupby(keys,sort=True)
+    table = pd.DataFrame({'purchases':grouped.size(),
+                          'unique_invoices':grouped['invoice'].nunique(),
+                          'unique_streams':grouped['stream_id'].nunique(),
+                          'total_views':grouped['times_viewed'].sum()})
+
+    ## sum each day as a contiguous slice so revenue is bit-for-bit the same as np.sum per day
+    codes = grouped.ngroup().values
+    order = np.argsort(codes,kind='stable')
+    bounds = np.cumsum(np.bincount(codes,minlength=table.shape[0]))[:-1]
+    prices = df['price'].values[order]
+    table['revenue'] = np.array([part.sum() for part in np.split(prices,bounds)],dtype=prices.dtype)
+    return(table)
+
+
+def _daily_ts(table, start_month, stop_month):
+    """
+    spread the aggregated days (see _aggregate_days) over a date range
+    days without invoices are filled with zeros
+    """
+
+    days = np.arange(start_month,stop_month,dtype='datetime64[D]')
+    table_days = table.index.get_level_values('invoice_date').values.astype('datetime64[D]')
+    position = (table_days - np.datetime64(start_month,'D')).astype(int)
+    keep = (position >= 0) & (position < days.size)
+
+    columns = {}
+    for column in TS_COLUMNS:
+        values = np.zeros(days.size,dtype=table[column].dtype)
+        values[position[keep]] = table[column].values[keep]
+        columns[column] = values
+
+    df_time = pd.DataFrame({'date':days,
+                            'purchases':columns['purchases'],
+                            'unique_invoices':columns['unique_invoices'],
+                            'unique_streams':columns['unique_streams'],
+                            'total_views':columns['total_views'],
+                            'year_month':days.astype('datetime64[M]').astype(str),
+                            'revenue':columns['revenue']})
+    return(df_time)
+
+
 def convert_to_ts(df_orig, country=None):
     """
     given the original DataFrame (fetch_data())
@@ -78,7 +175,7 @@ def convert_to_ts(df_orig, country=None):
 
     if country:
         if country not in np.unique(df_orig['country'].values):
-            raise Excpetion("country not found")
+            raise Exception("country not found")
     
         mask = df_orig['country'] == country
         df = df_orig[mask]
@@ -86,77 +183,440 @@ def convert_to_ts(df_orig, country=None):
         df = df_orig
         
     ## use a date range to ensure all days are accounted for in the data
-    invoice_dates = df['invoice_date'].values
-    start_month = '{}-{}'.format(df['year'].values[0],str(df['month'].values[0]).zfill(2))
-    stop_month = '{}-{}'.format(df['year'].values[-1],str(df['month'].values[-1]).zfill(2))
-    df_dates = df['invoice_date'].values.astype('datetime64[D]')
-    days = np.arange(start_month,stop_month,dtype='datetime64[D]')
-    
-    purchases = np.array([np.where(df_dates==day)[0].size for day in days])
-    invoices = [np.unique(df[df_dates==day]['invoice'].values).size for day in days]
-    streams = [np.unique(df[df_dates==day]['stream_id'].values).size for day in days]
-    views =  [df[df_dates==day]['times_viewed'].values.sum() for day in days]
-    revenue = [df[df_dates==day]['price'].values.sum() for day in days]
-    year_month = ["-".join(re.split("-",str(day))[:2]) for day in days]
+    months = df['invoice_date'].values.astype('datetime64[M]')
+    return(_daily_ts(_aggregate_days(df),months[0],months[-1]))
+
+
+def convert_countries_to_ts(df_orig, countries):
+    """
+    same as convert_to_ts() for several countries at once
+    all countries are aggregated with a single pass over the data
+    returns a dict of time-series DataFrames keyed by country
+    """
+
+    found = set(np.unique(df_orig['country'].values))
+    for country in countries:
+        if country not in found:
+            raise Exception("country not found")
+
+    table = _aggregate_days(df_orig,by='country')
+    months = pd.Series(df_orig['invoice_date'].values.astype('datetime64[M]'),
+                       index=df_orig.index).groupby(df_orig['country'])
+    first,last = months.first(),months.last()
+
+    dfs = {}
+    for country in countries:
+        dfs[country] = _daily_ts(table.loc[country],
+                                 np.datetime64(first[country],'M'),
+                                 np.datetime64(last[country],'M'))
+    return(dfs)
+
+
+def _source_files(data_dir):
+    """
+    sorted list of the invoice json files in data_dir
+    """
+
+    if not os.path.isdir(data_dir):
+        return([])
+    return(sorted([f for f in os.listdir(data_dir) if re.search("\.json",f) and f != TS_MANIFEST]))
+
+
+def _hash_sources(data_dir, known=None):
+    """
+    content hash of the invoice json files in data_dir
+
+    files with the same name, size and modification time as an entry in 'known'
+    (the 'sources' of a manifest) are not read again
+    returns the combined digest and the per file entries
+    """
+
+    known = known or {}
+    sources = {}
+    combined = hashlib.sha1()
+    for file_name in _source_files(data_dir):
+        stat = os.stat(os.path.join(data_dir,file_name))
+        entry = known.get(file_name,{})
+        if entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime_ns:
+            file_hash = hashlib.sha1()
+            with open(os.path.join(data_dir,file_name),'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE),b""):
+                    file_hash.update(block)
+            entry = {'size':stat.st_size,'mtime':stat.st_mtime_ns,'sha1':file_hash.hexdigest()}
+        sources[file_name] = entry
+        combined.update("{}:{}\n".format(file_name,entry['sha1']).encode())
+
+    return(combined.hexdigest(),sources)
+
+
+def _read_manifest(ts_data_dir):
+    """
+    read the manifest of the time-series store (None if there is no store)
+    manifests are cached until the file changes on disk
+    """
+
+    path = os.path.join(ts_data_dir,TS_MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return(None)
+
+    cached = _manifests.get(path)
+    if cached and cached[0] == mtime:
+        return(cached[1])
+
+    with open(path) as f:
+        manifest = json.load(f)
+    _manifests[path] = (mtime,manifest)
+    return(manifest)
+
+
+def _country_id(country):
+    """
+    name used for a country in the store and in file names
+    """
+
+    return(re.sub("\s+","_",country.lower()))
+
+
+def _aggregate_series(df):
+    """
+    daily aggregates over whole months for 'all' and for every country
+    unlike convert_to_ts() the last month is kept, so later months can be appended
+    returns the series keyed by country id and the revenue per country
+    """
+
+    months = df['invoice_date'].values.astype('datetime64[M]')
+    series = {'all':_daily_ts(_aggregate_days(df),months.min(),months.max()+1)}
+
+    table = _aggregate_days(df,by='country')
+    by_country = pd.Series(months,index=df.index).groupby(df['country'])
+    first,last = by_country.min(),by_country.max()
+    for country in first.index:
+        series[_country_id(country)] = _daily_ts(table.loc[country],
+                                                 np.datetime64(first[country],'M'),
+                                                 np.datetime64(last[country],'M')+1)
+
+    revenue = df.groupby('country')['price'].sum()
+    return(series,{country:float(total) for country,total in revenue.items()})
 
-    df_time = pd.DataFrame({'date':days,
-                            'purchases':purchases,
-                            'unique_invoices':invoices,
-                            'unique_streams':streams,
-                            'total_views':views,
-                            'year_month':year_month,
-                            'revenue':revenue})
-    return(df_time)
+
+def _merge_series(df_old, df_new):
+    """
+    combine stored daily aggregates with the aggregates of new invoices
+    unique counts cannot be combined, so None is returned when both have invoices on the same day
+    """
+
+    dates_old = df_old['date'].to_numpy().astype('datetime64[D]')
+    dates_new = df_new['date'].to_numpy().astype('datetime64[D]')
+    start = min(dates_old[0],dates_new[0])
+    days = np.arange(start,max(dates_old[-1],dates_new[-1])+1,dtype='datetime64[D]')
+    position_old = (dates_old - start).astype(int)
+    position_new = (dates_new - start).astype(int)
+
+    occupied = np.zeros(days.size,dtype=bool)
+    occupied[position_old[df_old['purchases'].to_numpy() > 0]] = True
+    if occupied[position_new[df_new['purchases'].to_numpy() > 0]].any():
+        return(None)
+
+    columns = {}
+    for column in TS_COLUMNS:
+        values = np.zeros(days.size,dtype=df_old[column].dtype)
+        values[position_old] += df_old[column].to_numpy()
+        values[position_new] += df_new[column].to_numpy()
+        columns[column] = values
+
+    return(pd.DataFrame({'date':days,
+                         'purchases':columns['purchases'],
+                         'unique_invoices':columns['unique_invoices'],
+                         'unique_streams':columns['unique_streams'],
+                         'total_views':columns['total_views'],
+                         'year_month':days.astype('datetime64[M]').astype(str),
+                         'revenue':columns['revenue']}))
+
+
+def _top_countries(revenue, n=10):
+    """
+    country ids of the n countries with the highest revenue
+    """
+
+    ranking = sorted(revenue.items(),key=lambda item: item[1],reverse=True)
+    return([_country_id(country) for country,total in ranking[:n]])
+
+
+def _write_store(ts_data_dir, dfs, manifest, reuse=None, keep_last_month=False):
+    """
+    save the daily aggregates as one .npy file per column and country
+
+    the arrays go into a new version directory and the manifest is swapped in last
+    so readers never see a half written store
+    writers take turns, so that one never removes the version another is writing
+    series listed in 'reuse' are unchanged and are linked from the current version
+    the last TS_KEEP_VERSIONS versions are kept, older ones are removed
+    'keep_last_month' is for series that were already cut like convert_to_ts() does
+    """
+
+    with open(os.path.join(ts_data_dir,TS_MANIFEST+".lock"),'w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        version = "store-{}".format(uuid.uuid4().hex[:12])
+        series = {key:manifest['series'][key] for key in reuse or []}
+        for key in reuse or []:
+            shutil.copytree(os.path.join(ts_data_dir,manifest['version'],key),
+                            os.path.join(ts_data_dir,version,key),copy_function=os.link)
+
+        for key,df in dfs.items():
+            key_dir = os.path.join(ts_data_dir,version,key)
+            os.makedirs(key_dir)
+            dates = df['date'].to_numpy().astype('datetime64[D]')
+            np.save(os.path.join(key_dir,"date.npy"),dates)
+            np.save(os.path.join(key_dir,"year_month.npy"),df['year_month'].to_numpy().astype('U7'))
+            for column in TS_COLUMNS:
+                np.save(os.path.join(key_dir,column+".npy"),df[column].to_numpy())
+
+            ## the last month only becomes part of the series once a later month arrives
+            rows = dates.size
+            if not keep_last_month and dates.size > 0:
+                months = dates.astype('datetime64[M]')
+                rows = int(np.sum(months < months[-1]))
+            series[key] = {'rows':rows,'days':int(dates.size)}
+
+        current = _read_manifest(ts_data_dir)
+        versions = current.get('versions',[current['version']]) if current else []
+        versions = (versions + [version])[-TS_KEEP_VERSIONS:]
+        manifest = dict(manifest,version=version,versions=versions,series=series)
+        ## every writer has its own temporary file, like its own version directory
+        manifest_tmp = os.path.join(ts_data_dir,"{}.{}.tmp".format(TS_MANIFEST,version))
+        with open(manifest_tmp,'w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(manifest_tmp,os.path.join(ts_data_dir,TS_MANIFEST))
+
+        ## the previous version stays for readers that found it in the manifest before the swap
+        ## (older ones can go, processes that still map them keep their pages)
+        _remove_store(ts_data_dir,keep=versions)
+        return(manifest)
+
+
+def _remove_store(ts_data_dir, keep=()):
+    """
+    remove store versions (all but the ones in 'keep')
+    """
+
+    for name in os.listdir(ts_data_dir):
+        if name.startswith("store-") and name not in keep:
+            shutil.rmtree(os.path.join(ts_data_dir,name),ignore_errors=True)
+    if not keep and os.path.exists(os.path.join(ts_data_dir,TS_MANIFEST)):
+        os.remove(os.path.join(ts_data_dir,TS_MANIFEST))
+
+
+def _read_csv_cache(ts_data_dir):
+    """
+    time-series saved as ts-*.csv files by earlier versions of fetch_ts
+    """
+
+    csv_files = sorted([f for f in os.listdir(ts_data_dir) if re.search("^ts-.+\.csv$",f)])
+    return({re.sub("\.csv","",cf)[3:]:pd.read_csv(os.path.join(ts_data_dir,cf)) for cf in csv_files})
 
 
-def fetch_ts(data_dir, clean=False):
+def ts_countries(ts_data_dir=TS_DATA_DIR):
+    """
+    list the countries in the time-series store without loading any data
+    ('all' and the top ten countries wrt revenue)
+    """
+
+    manifest = _read_manifest(ts_data_dir)
+    if manifest is None:
+        return([])
+    return(manifest['countries'])
+
+
+def ts_version(ts_data_dir=TS_DATA_DIR):
+    """
+    version of the time-series store (None if there is no store)
+    changes whenever the stored data changes
+    """
+
+    manifest = _read_manifest(ts_data_dir)
+    if manifest is None:
+        return(None)
+    return(manifest['version'])
+
+
+def load_ts(country, ts_data_dir=TS_DATA_DIR, complete=False):
+    """
+    load the time-series of one country from the store
+    the column files are memory mapped so nothing is parsed
+
+    like convert_to_ts() the last month is left out unless 'complete' is set
+    """
+
+    manifest = _read_manifest(ts_data_dir)
+    if manifest is None or country not in manifest['series']:
+        raise Exception("time-series for '{}' not found in {}".format(country,ts_data_dir))
+
+    rows = manifest['series'][country]['days' if complete else 'rows']
+    key_dir = os.path.join(ts_data_dir,manifest['version'],country)
+    columns = {}
+    for column in ['date','purchases','unique_invoices','unique_streams','total_views','year_month','revenue']:
+        columns[column] = np.load(os.path.join(key_dir,column+".npy"),mmap_mode='r')[:rows]
+
+    return(pd.DataFrame(columns))
+
+
+def _aggregate_files(data_dir, file_names):
+    """
+    aggregate the files one at a time (see iter_data) and merge their daily series
+    so only a few files are in memory at once
+    returns None if two files have invoices on the same day
+    """
+
+    series,revenue = {},{}
+    for df in iter_data(data_dir,file_names=file_names):
+        if df.shape[0] == 0:
+            continue
+        series_file,revenue_file = _aggregate_series(df)
+        for key,df_file in series_file.items():
+            if key in series:
+                series[key] = _merge_series(series[key],df_file)
+                if series[key] is None:
+                    return(None)
+            else:
+                series[key] = df_file
+        for country,total in revenue_file.items():
+            revenue[country] = revenue.get(country,0.0) + total
+
+    return(series,revenue)
+
+
+def _build_store(data_dir, ts_data_dir, source_hash, sources):
+    """
+    aggregate every json file in data_dir into a new store
+    """
+
+    print("... processing data for loading")
+    aggregated = _aggregate_files(data_dir,list(sources.keys()))
+    if aggregated is None:
+        ## files share days, so all of the data has to be aggregated at once
+        aggregated = _aggregate_series(fetch_data(data_dir,file_names=list(sources.keys())))
+    print("...fetched data")
+
+    series,revenue = aggregated
+    manifest = {'source_hash':source_hash,
+                'sources':sources,
+                'revenue':revenue,
+                'countries':['all'] + _top_countries(revenue)}
+    return(_write_store(ts_data_dir,series,manifest))
+
+
+def _ingest_store(data_dir, ts_data_dir, manifest, source_hash, sources):
+    """
+    fold json files that are not yet in the store into the stored series
+    returns None if the store has to be rebuilt instead
+    (a source file changed or disappeared, or new invoices fall on days already stored)
+    """
+
+    if 'revenue' not in manifest:
+        return(None)
+    known = manifest['sources']
+    for file_name,entry in known.items():
+        if file_name not in sources or sources[file_name]['sha1'] != entry['sha1']:
+            return(None)
+
+    new_files = [f for f in sources if f not in known]
+    print("... ingesting {} new file(s)".format(len(new_files)))
+    aggregated = _aggregate_files(data_dir,new_files)
+    if aggregated is None:
+        return(None)
+    series_new,revenue_new = aggregated
+
+    series = {}
+    for key,df_new in series_new.items():
+        if key in manifest['series']:
+            series[key] = _merge_series(load_ts(key,ts_data_dir,complete=True),df_new)
+            if series[key] is None:
+                return(None)
+        else:
+            series[key] = df_new
+
+    revenue = dict(manifest['revenue'])
+    for country,total in revenue_new.items():
+        revenue[country] = revenue.get(country,0.0) + total
+
+    manifest = dict(manifest,
+                    source_hash=source_hash,
+                    sources=sources,
+                    revenue=revenue,
+                    countries=['all'] + _top_countries(revenue))
+    reuse = [key for key in manifest['series'] if key not in series]
+    return(_write_store(ts_data_dir,series,manifest,reuse=reuse))
+
+
+def fetch_ts(data_dir, clean=False, ts_data_dir=TS_DATA_DIR, incremental=True):
     """
     convenience function to read in new data
-    uses csv to load quickly
+    uses a memory mapped store to load quickly
     use clean=True when you want to re-create the files
+
+    the store follows the content of the json files in data_dir
+    with 'incremental' only files that were added since the last call are read
+    and their days are appended to the stored series
     """
 
-    #ts_data_dir = os.path.join(data_dir,"ts_data")
-    ts_data_dir="./data/cs_train/data"
-    if clean:
-        shutil.rmtree(ts_data_dir)
     if not os.path.exists(ts_data_dir):
-        os.mkdir(ts_data_dir)
+        os.makedirs(ts_data_dir)
+    if clean:
+        _remove_store(ts_data_dir)
+
+    manifest = _read_manifest(ts_data_dir)
+    source_hash,sources = _hash_sources(data_dir,manifest['sources'] if manifest else None)
 
-    ## if files have already been processed load them        
-    if len(os.listdir(ts_data_dir)) > 0:
+    ## if the files have already been processed load them
+    ## (without json files in data_dir there is nothing to check the store against)
+    if manifest is not None and (len(sources) == 0 or source_hash == manifest['source_hash']):
         print("... loading ts data from files")
-        return({re.sub("\.csv","",cf)[3:]:pd.read_csv(os.path.join(ts_data_dir,cf)) for cf in os.listdir(ts_data_dir)})
+        return({key:load_ts(key,ts_data_dir) for key in manifest['countries']})
+
+    if len(sources) == 0:
+        ## nothing to build from, carry over a csv cache written by an earlier version
+        dfs = _read_csv_cache(ts_data_dir)
+        if len(dfs) == 0:
+            raise Exception("specified data dir does not contain any files")
+        print("... converting csv ts data")
+        manifest = {'source_hash':source_hash,'sources':sources,'countries':list(dfs.keys())}
+        _write_store(ts_data_dir,dfs,manifest,keep_last_month=True)
+        return({key:load_ts(key,ts_data_dir) for key in dfs.keys()})
+
+    if manifest is not None and incremental:
+        manifest = _ingest_store(data_dir,ts_data_dir,manifest,source_hash,sources)
+    else:
+        manifest = None
+    if manifest is None:
+        manifest = _build_store(data_dir,ts_data_dir,source_hash,sources)
 
-    ## get original data
-    print("... processing data for loading")
-    df = fetch_data(data_dir)
-    print("...fetched data")
+    return({key:load_ts(key,ts_data_dir) for key in manifest['countries']})
 
-    ## find the top ten countries (wrt revenue)
-    table = pd.pivot_table(df,index='country',values="price",aggfunc='sum')
-    table.columns = ['total_revenue']
-    table.sort_values(by='total_revenue',inplace=True,ascending=False)
-    top_ten_countries =  np.array(list(table.index))[:10]
 
-    file_list = [os.path.join(data_dir,f) for f in os.listdir(data_dir) if re.search("\.json",f)]
-    countries = [os.path.join(data_dir,"ts-"+re.sub("\s+","_",c.lower()) + ".csv") for c in top_ten_countries]
+def _prefix_sum(offsets, values, n_days):
+    """
+    cumulative sum of values placed on a dense daily grid
+    entry i holds the total of all days before day i
+    """
+
+    daily = np.bincount(offsets,weights=values,minlength=n_days)
+    return(np.concatenate(([0],np.cumsum(daily))))
 
-    ## load the data
-    dfs = {}
-    dfs['all'] = convert_to_ts(df)
-    for country in top_ten_countries:
-        country_id = re.sub("\s+","_",country.lower())
-        file_name = os.path.join(data_dir,"ts-"+ country_id + ".csv")
-        dfs[country_id] = convert_to_ts(df,country=country)
-
-    ## save the data as csvs    
-    for key, item in dfs.items():
-        item.to_csv(os.path.join(ts_data_dir,"ts-"+key+".csv"),index=False)
-        
-    return(dfs)
 
-def engineer_features(df,training=True):
+def _window_sum(prefix, offsets, start, stop):
+    """
+    for every day d the total over the days [d+start, d+stop) using a prefix sum
+    """
+
+    n_days = prefix.size - 1
+    lower = np.clip(offsets+start,0,n_days)
+    upper = np.clip(offsets+stop,0,n_days)
+    return(prefix[upper] - prefix[lower])
+
+
+def engineer_features(df,training=True,previous=None,target_days=30):
     """
     for any given day the target becomes the sum of the next days revenue
     for that day we engineer several features that help predict the summed revenue
@@ -164,41 +624,45 @@ def engineer_features(df,training=True):
     the 'training' flag will trim data that should not be used for training
     when set to false all data will be returned
 
+    'previous' is the list of look-back windows (in days) that revenue is summed over
+    'target_days' is the number of days ahead that make up the target
+
+    every window is computed from cumulative sums so the cost is linear in the number of days
     """
 
+    if previous is None:
+        previous = PREVIOUS_WINDOWS
+
     ## extract dates
-    dates = df['date'].values.copy()
+    dates = df['date'].to_numpy().copy()
     dates = dates.astype('datetime64[D]')
 
+    ## day offsets on a dense daily grid (missing days simply contribute nothing)
+    offsets = (dates - dates.min()).astype(int)
+    n_days = offsets.max() + 1
+    revenue = _prefix_sum(offsets,df['revenue'].values,n_days)
+    invoices = _prefix_sum(offsets,df['unique_invoices'].values,n_days)
+    views = _prefix_sum(offsets,df['total_views'].values,n_days)
+    counts = _prefix_sum(offsets,None,n_days)
+
     ## engineer some features
-    eng_features = defaultdict(list)
-    previous =[7, 14, 28, 70]  #[7, 14, 21, 28, 35, 42, 49, 56, 63, 70]
-    y = np.zeros(dates.size)
-    for d,day in enumerate(dates):
-
-        ## use windows in time back from a specific date
-        for num in previous:
-            current = np.datetime64(day, 'D') 
-            prev = current - np.timedelta64(num, 'D')
-            mask = np.in1d(dates, np.arange(prev,current,dtype='datetime64[D]'))
-            eng_features["previous_{}".format(num)].append(df[mask]['revenue'].sum())
-
-        ## get get the target revenue    
-        plus_30 = current + np.timedelta64(30,'D')
-        mask = np.in1d(dates, np.arange(current,plus_30,dtype='datetime64[D]'))
-        y[d] = df[mask]['revenue'].sum()
-
-        ## attempt to capture monthly trend with previous years data (if present)
-        start_date = current - np.timedelta64(365,'D')
-        stop_date = plus_30 - np.timedelta64(365,'D')
-        mask = np.in1d(dates, np.arange(start_date,stop_date,dtype='datetime64[D]'))
-        eng_features['previous_year'].append(df[mask]['revenue'].sum())
-
-        ## add some non-revenue features
-        minus_30 = current - np.timedelta64(30,'D')
-        mask = np.in1d(dates, np.arange(minus_30,current,dtype='datetime64[D]'))
-        eng_features['recent_invoices'].append(df[mask]['unique_invoices'].mean())
-        eng_features['recent_views'].append(df[mask]['total_views'].mean())
+    eng_features = {}
+
+    ## use windows in time back from a specific date
+    for num in previous:
+        eng_features["previous_{}".format(num)] = _window_sum(revenue,offsets,-num,0)
+
+    ## get get the target revenue
+    y = _window_sum(revenue,offsets,0,target_days)
+
+    ## attempt to capture monthly trend with previous years data (if present)
+    eng_features['previous_year'] = _window_sum(revenue,offsets,-365,target_days-365)
+
+    ## add some non-revenue features
+    with np.errstate(invalid='ignore',divide='ignore'):
+        recent_days = _window_sum(counts,offsets,-30,0)
+        eng_features['recent_invoices'] = _window_sum(invoices,offsets,-30,0) / recent_days
+        eng_features['recent_views'] = _window_sum(views,offsets,-30,0) / recent_days
 
     X = pd.DataFrame(eng_features)
     ## combine features in to df and remove rows with all zeros
@@ -210,8 +674,8 @@ def engineer_features(df,training=True):
     X.reset_index(drop=True, inplace=True)
 
     if training == True:
-        ## remove the last 30 days (because the target is not reliable)
-        mask = np.arange(X.shape[0]) < np.arange(X.shape[0])[-30]
+        ## remove the last days that make up the target (because the target is not reliable)
+        mask = np.arange(X.shape[0]) < np.arange(X.shape[0])[-target_days]
         X = X[mask]
         y = y[mask]
         dates = dates[mask]
@@ -1,4 +1,6 @@
 import time,os,re,csv,sys,uuid,joblib
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import date
 from collections import defaultdict
 import numpy as np
@@ -11,14 +13,20 @@ from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.pipeline import Pipeline
 
 #from logger import update_predict_log, update_train_log
-from cslib import fetch_ts, engineer_features
+from logger import update_train_log
+from cslib import fetch_ts, engineer_features, load_ts, ts_countries, ts_version
 
 ## model specific variables (iterate the version and note with each change)
 MODEL_DIR = "models"
 MODEL_VERSION = 0.1
 MODEL_VERSION_NOTE = "supervised learing model for time-series"
 
-def _model_train(df,tag,test=False):
+## process-wide registry of loaded models and engineered features
+_models = {}
+_features = {}
+_registry_lock = threading.Lock()
+
+def _model_train(df,tag,test=False,n_jobs=-1):
     """
     example funtion to train model
     
@@ -26,6 +34,8 @@ def _model_train(df,tag,test=False):
         (1) subsets the data and serializes a test version
         (2) specifies that the use of the 'test' log file 
 
+    'n_jobs' is the number of cores used by the grid search
+    returns the shape of the training data and the runtime
     """
 
 
@@ -55,7 +65,7 @@ def _model_train(df,tag,test=False):
     pipe_rf = Pipeline(steps=[('scaler', StandardScaler()),
                               ('rf', RandomForestRegressor())])
     
-    grid = GridSearchCV(pipe_rf, param_grid=param_grid_rf, cv=5, iid=False, n_jobs=-1)
+    grid = GridSearchCV(pipe_rf, param_grid=param_grid_rf, cv=5, iid=False, n_jobs=n_jobs)
     grid.fit(X_train, y_train)
     y_pred = grid.predict(X_test)
     eval_rmse =  round(np.sqrt(mean_squared_error(y_test,y_pred)))
@@ -78,16 +88,31 @@ def _model_train(df,tag,test=False):
     h, m = divmod(m, 60)
     runtime = "%03d:%02d:%02d"%(h, m, s)
 
-    ## update log
-    """ update_train_log(tag,(str(dates[0]),str(dates[-1])),{'rmse':eval_rmse},runtime,
-                     MODEL_VERSION, MODEL_VERSION_NOTE,test=True) """
-  
+    ## the log is updated by model_train (workers should not write to it concurrently)
+    return(X.shape,runtime)
+
 
-def model_train(data_dir,test=False):
+def _cpu_budget(n_countries,n_jobs=None):
+    """
+    split the available cores between countries trained at the same time
+    and the grid search inside each of them
+    returns (number of countries in parallel, cores per grid search)
+    """
+
+    if not n_jobs or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_workers = max(1,min(n_countries,n_jobs))
+    return(n_workers,max(1,n_jobs // n_workers))
+
+
+def model_train(data_dir,test=False,n_jobs=None):
     """
     funtion to train model given a df
     
     'mode' -  can be used to subset data essentially simulating a train
+
+    the countries are trained concurrently, largest first,
+    within a budget of 'n_jobs' cores (all cores by default)
     """
     
     if not os.path.isdir(MODEL_DIR):
@@ -97,80 +122,156 @@ def model_train(data_dir,test=False):
         print("... test flag on")
         print("...... subseting data")
         print("...... subseting countries")
-        
+
+    ## start timer for runtime
+    time_start = time.time()
+
     ## fetch time-series formatted data
     ts_data = fetch_ts(data_dir)
     #ts_data = pd.read_csv("./data/cs_train/ts_data")
+
+    ## days with revenue are the training samples, so start with the largest countries
+    countries = sorted(ts_data.keys(),key=lambda c: (ts_data[c]['revenue'].values != 0).sum(),reverse=True)
+    n_workers,n_grid_jobs = _cpu_budget(len(countries),n_jobs)
+    print("... training {} countries, {} at a time with {} core(s) each".format(len(countries),n_workers,n_grid_jobs))
+
     ## train a different model for each data sets
-    for country,df in ts_data.items():
-        
-        #if test and country not in ['all','united_kingdom']:
-        #    continue
-        
-        _model_train(df,country,test=test)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_model_train,ts_data[country],country,test,n_grid_jobs):country
+                   for country in countries}
+        for future in as_completed(futures):
+            country = futures[future]
+            data_shape,runtime = future.result()
+            print("... {} trained in {}".format(country,runtime))
+            update_train_log(data_shape,runtime,MODEL_VERSION,
+                             "{} ({})".format(MODEL_VERSION_NOTE,country),test)
+
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    runtime = "%03d:%02d:%02d"%(h, m, s)
+    update_train_log((len(countries),),runtime,MODEL_VERSION,
+                     "{} (all countries)".format(MODEL_VERSION_NOTE),test)
     
+def _model_file(country,prefix='test'):
+    """
+    file name of a saved model
+    """
+
+    model_name = re.sub("\.","_",str(MODEL_VERSION))
+    return(os.path.join(MODEL_DIR,"{}-{}-{}.joblib".format(prefix,country,model_name)))
+
+
+def _get_model(country,prefix='test'):
+    """
+    model of a country from the process-wide registry
+    loaded on first use and again only when the model file changes
+    """
+
+    model_file = _model_file(country,prefix)
+    try:
+        mtime = os.stat(model_file).st_mtime_ns
+    except FileNotFoundError:
+        raise Exception("ERROR (model_predict) - model for country '{}' could not be found".format(country))
+
+    key = (prefix,country)
+    entry = _models.get(key)
+    if entry is None or entry['mtime'] != mtime:
+        with _registry_lock:
+            entry = _models.get(key)
+            if entry is None or entry['mtime'] != mtime:
+                entry = {'mtime':mtime,'model':joblib.load(model_file)}
+                _models[key] = entry
+    return(entry['model'])
+
+
+def _get_features(country,data_dir=None,training=False):
+    """
+    engineered features of a country from the process-wide registry
+    indexed by date, recomputed only when the time-series store changes
+    """
+
+    version = ts_version()
+    if version is None:
+        ## no store yet, let fetch_ts create it
+        fetch_ts(data_dir or os.path.join("data","cs_train"))
+        version = ts_version()
+
+    key = (country,training)
+    entry = _features.get(key)
+    if entry is None or entry['version'] != version:
+        with _registry_lock:
+            entry = _features.get(key)
+            if entry is None or entry['version'] != version:
+                X,y,dates = engineer_features(load_ts(country),training=training)
+                dates = np.array([str(d) for d in dates])
+                entry = {'version':version,'X':X,'y':y,'dates':dates,
+                         'index':{d:i for i,d in enumerate(dates)}}
+                _features[key] = entry
+    return(entry)
+
+
 def model_load(prefix='test',data_dir=None,training=True):
     """
     example funtion to load model
     
     The prefix allows the loading of different models
+    models and features are kept in a registry so later calls are served from memory
     """
 
     if not data_dir:
         data_dir = os.path.join("data","cs-train")
     
-    models = [f for f in os.listdir(os.path.join(".","models")) if re.search("test",f)]
+    models = [f for f in os.listdir(MODEL_DIR) if re.search("^{}-".format(prefix),f)]
 
     if len(models) == 0:
         raise Exception("Models with prefix '{}' cannot be found did you train?".format(prefix))
 
     all_models = {}
     for model in models:
-        all_models[re.split("-",model)[1]] = joblib.load(os.path.join(".","models",model))
+        country = re.split("-",model)[1]
+        all_models[country] = _get_model(country,prefix)
 
     ## load data
-    ts_data = fetch_ts(data_dir)
+    fetch_ts(data_dir)
     all_data = {}
-    for country, df in ts_data.items():
-        X,y,dates = engineer_features(df,training=training)
-        dates = np.array([str(d) for d in dates])
-        all_data[country] = {"X":X,"y":y,"dates": dates}
+    for country in ts_countries():
+        entry = _get_features(country,data_dir,training=training)
+        all_data[country] = {"X":entry['X'],"y":entry['y'],"dates":entry['dates']}
         
     return(all_data, all_models)
 
-def model_predict(country,year,month,day,all_models=None,test=False):
+def model_predict(country,year,month,day,all_models=None,test=False,prefix='test'):
     """
     example funtion to predict from model
+
+    models and features come from the registry (see model_load)
+    so a prediction is a dictionary lookup and a single call to predict
     """
 
     ## start timer for runtime
     time_start = time.time()
 
-    ## load model if needed
-    if not all_models:
-        all_data,all_models = model_load(training=False)
-    
     ## input checks
-    if country not in all_models.keys():
+    if all_models and country not in all_models.keys():
         raise Exception("ERROR (model_predict) - model for country '{}' could not be found".format(country))
 
     for d in [year,month,day]:
         if re.search("\D",d):
             raise Exception("ERROR (model_predict) - invalid year, month or day")
     
-    ## load data
-    model = all_models[country]
-    data = all_data[country]
+    ## load model and data if needed
+    model = all_models[country] if all_models else _get_model(country,prefix)
+    data = _get_features(country)
 
     ## check date
     target_date = "{}-{}-{}".format(year,str(month).zfill(2),str(day).zfill(2))
     print(target_date)
 
-    if target_date not in data['dates']:
+    if target_date not in data['index']:
         raise Exception("ERROR (model_predict) - date {} not in range {}-{}".format(target_date,
                                                                                     data['dates'][0],
                                                                                     data['dates'][-1]))
-    date_indx = np.where(data['dates'] == target_date)[0][0]
+    date_indx = data['index'][target_date]
     query = data['X'].iloc[[date_indx]]
     
     ## sainty check
@@ -3,59 +3,198 @@ In this file, the functions for training and predicting with Prophet are defined
 """
 
 import os
+import json
+import uuid
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+import numpy as np
 import pandas as pd
 from fbprophet import Prophet
-from cslib import fetch_ts
-import re
+from fbprophet.serialize import model_to_json, model_from_json
+from cslib import fetch_ts, ts_countries
 from logger import update_predict_log, update_train_log
 import time
 
 MODEL_VERSION = 0.1
 MODEL_VERSION_NOTE = "Prophet"
+FORECAST_DIR = os.path.join("data","forecasts")
+MODEL_DIR = "models"
+PROPHET_MANIFEST = "prophet-manifest.json"
+
+## forecasts read by this process (see load_forecast)
+_forecasts = {}
+
+## the fitting processes are started by a server process with this module loaded, instead of being forked
+## from the caller (forking the multithreaded app while another thread holds a lock can deadlock the child)
+_FIT_CONTEXT = get_context("forkserver")
+_FIT_CONTEXT.set_forkserver_preload([__name__])
+
+def _series_hash(df):
+    """
+    hash of the data a country's model is fit on
+    """
+
+    series_hash=hashlib.sha1()
+    series_hash.update(df['date'].to_numpy().astype('datetime64[D]').tobytes())
+    series_hash.update(df['revenue'].to_numpy().astype(float).tobytes())
+    return series_hash.hexdigest()
+
+def _tmp_name(filename):
+    """
+    unique temporary name next to a file, for writing it and swapping it in with os.replace
+    (so readers in other requests or processes never see a half written file)
+    """
+
+    return "{}.{}.tmp".format(filename,uuid.uuid4().hex[:12])
+
+def _stan_init(m):
+    """
+    fitted parameters of a model, used to start the next fit from them
+    """
+
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = m.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = m.params[pname][0]
+    return res
+
+def _fit_country(country, df, warm_start=False):
+    """
+    fit the model of one country and save it with its forecast
+    (runs in a worker process of model_train)
+    """
+
+    time_start = time.time()
+    model_file=os.path.join(MODEL_DIR,"prophet-"+country+".json")
+    init=None
+    if warm_start and os.path.exists(model_file):
+        with open(model_file) as f:
+            init=_stan_init(model_from_json(f.read()))
+
+    m = Prophet()
+    df2=df[["date","revenue"]]
+    df2.columns = ['ds', 'y']
+    if init:
+        m.fit(df2, init=init)
+    else:
+        m.fit(df2)
+    future = m.make_future_dataframe(periods=120)
+    forecast = m.predict(future)
+    filename=os.path.join(FORECAST_DIR,"forecast_" + country)
+    tmp_file=_tmp_name(filename)
+    forecast.to_csv(tmp_file)
+    os.replace(tmp_file,filename)
+    tmp_file=_tmp_name(model_file)
+    with open(tmp_file,"w") as f:
+        f.write(model_to_json(m))
+    os.replace(tmp_file,model_file)
+
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    runtime = "%03d:%02d:%02d"%(h, m, s)
+    return forecast.shape, runtime
+
+def model_train(warm_start=False, only_changed=True, n_workers=None, progress=None):
+    """
+    fit one model per country in a pool of worker processes
+
+    'warm_start' starts each fit from the parameters of the previously saved model
+    'only_changed' skips countries whose time-series did not change since the last fit
+    'progress' is called with (country, status, runtime) as countries are queued, skipped and fitted
+    """
 
-def model_train():
     ## start timer for runtime
     time_start = time.time()
     data_dir = os.path.join("data","cs_train","data")
     ts_data = fetch_ts(data_dir)
 
-    for country,df in ts_data.items():
-        m = Prophet()
-        df2=df[["date","revenue"]]
-        df2.columns = ['ds', 'y']
-        m.fit(df2)
-        future = m.make_future_dataframe(periods=120)
-        forecast = m.predict(future)
-        forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail()
-        filename="data/forecasts/forecast_" + country
-        forecast.to_csv(filename)
-    
+    if not os.path.isdir(MODEL_DIR):
+        os.mkdir(MODEL_DIR)
+    manifest_file=os.path.join(MODEL_DIR,PROPHET_MANIFEST)
+    fitted={}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            fitted=json.load(f)
+
+    ## only fit countries with new data (or without a forecast)
+    hashes={country:_series_hash(df) for country,df in ts_data.items()}
+    countries=[country for country in ts_data.keys()
+               if not only_changed or fitted.get(country)!=hashes[country]
+               or not os.path.exists(os.path.join(FORECAST_DIR,"forecast_" + country))]
+    print("... fitting {} of {} countries".format(len(countries),len(ts_data)))
+    if progress:
+        for country in ts_data.keys():
+            progress(country, "queued" if country in countries else "unchanged", None)
+
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(),mp_context=_FIT_CONTEXT) as executor:
+        futures = {executor.submit(_fit_country,country,ts_data[country],warm_start):country
+                   for country in countries}
+        for future in as_completed(futures):
+            country = futures[future]
+            forecast_shape, runtime = future.result()
+            fitted[country]=hashes[country]
+            if progress:
+                progress(country, "fitted", runtime)
+            update_train_log(forecast_shape, runtime, MODEL_VERSION,
+                             "{} ({})".format(MODEL_VERSION_NOTE,country), False)
+
+    tmp_file=_tmp_name(manifest_file)
+    with open(tmp_file,"w") as f:
+        json.dump(fitted,f,indent=1)
+    os.replace(tmp_file,manifest_file)
+
     ## update the log file
     m, s = divmod(time.time()-time_start, 60)
     h, m = divmod(m, 60)
     runtime = "%03d:%02d:%02d"%(h, m, s)
     test=False
-    update_train_log(forecast.shape, runtime, MODEL_VERSION, MODEL_VERSION_NOTE, test)
+    update_train_log((len(countries),), runtime, MODEL_VERSION,
+                     "{} (all countries)".format(MODEL_VERSION_NOTE), test)
 
     return True
 
+def load_forecast(country):
+    """
+    forecast of a country indexed by date
+    forecasts are kept in memory and read again only when the file changes
+    (a new forecast replaces the file, so a changed inode tells it apart even within the same mtime)
+    """
+
+    filename=os.path.join(FORECAST_DIR,"forecast_"+country)
+    stat=os.stat(filename)
+    version=(stat.st_mtime_ns,stat.st_ino)
+    cached=_forecasts.get(country)
+    if cached is None or cached[0]!=version:
+        forecasts=pd.read_csv(filename)
+        forecasts.index=forecasts['ds'].values
+        cached=(version,forecasts)
+        _forecasts[country]=cached
+    return cached[1]
+
+def _countries():
+    data_dir = os.path.join("data","cs_train","data")
+    countries=ts_countries()
+    if len(countries)==0:
+        countries=list(fetch_ts(data_dir).keys())
+    return countries
+
 def model_predict(country, year, month, day):
     time_start = time.time()
-    data_dir = os.path.join("data","cs_train","data")
-    ts_data = fetch_ts(data_dir)
-    countries=[]
-    for c,df in ts_data.items():
-        countries.append(c)
+    countries=_countries()
 
     if(country not in countries):
         text="Could not find country called "+ country
         return(text)
 
     else:
-        filename="./data/forecasts/forecast_"+country
-        forecasts = pd.read_csv(filename)
+        forecasts = load_forecast(country)
         date_str=year + "-" + month + "-" + day
-        row=forecasts.loc[forecasts['ds'] == date_str]
+        if date_str in forecasts.index:
+            row=forecasts.loc[[date_str]]
+        else:
+            row=forecasts.iloc[0:0]
     
     
     if(len(row)==0):
@@ -69,6 +208,71 @@ def model_predict(country, year, month, day):
         update_predict_log(row.yhat.values[0],runtime,MODEL_VERSION,MODEL_VERSION_NOTE, test)
         return row
 
+def model_predict_batch(queries=None, ranges=None):
+    """
+    predict many dates at once
+    'queries' is a list of dicts with country, year, month and day
+    'ranges' is a list of dicts with country, start and end date (inclusive)
+    returns a list of dicts with country, date, yhat, yhat_lower and yhat_upper
+    (or an error for unknown countries, malformed dates and missing forecasts,
+    without failing the rest of the batch)
+    """
+
+    time_start = time.time()
+    countries=_countries()
+
+    ## group the requested dates by country (a malformed date is kept as given, with its error)
+    requested=[]
+    for query in queries or []:
+        if not isinstance(query,dict):
+            requested.append((None,[None],"Invalid query "+str(query)))
+            continue
+        try:
+            date_str=pd.Timestamp(year=int(query['year']),month=int(query['month']),day=int(query['day'])).strftime("%Y-%m-%d")
+            requested.append((query.get('country'),[date_str],None))
+        except (KeyError,TypeError,ValueError):
+            date_str="{}-{}-{}".format(query.get('year'),query.get('month'),query.get('day'))
+            requested.append((query.get('country'),[date_str],"Invalid date "+date_str))
+    for query in ranges or []:
+        if not isinstance(query,dict):
+            requested.append((None,[None],"Invalid range "+str(query)))
+            continue
+        try:
+            dates=pd.date_range(query['start'],query['end'],freq='D').strftime("%Y-%m-%d")
+            requested.append((query.get('country'),list(dates),None))
+        except (KeyError,TypeError,ValueError):
+            date_str="{}/{}".format(query.get('start'),query.get('end'))
+            requested.append((query.get('country'),[date_str],"Invalid date range "+date_str))
+
+    predictions=[]
+    for country,dates,error in requested:
+        if error is None and country not in countries:
+            error="Could not find country called "+ str(country)
+        if error is None:
+            try:
+                forecasts=load_forecast(country)
+            except FileNotFoundError:
+                error="Could not find a forecast for "+ country
+        if error is not None:
+            predictions.extend([{'country':country,'date':d,'error':error} for d in dates])
+            continue
+
+        rows=forecasts.reindex(dates)[['yhat','yhat_lower','yhat_upper']]
+        for date_str,values in zip(dates,rows.values):
+            if np.isnan(values[0]):
+                predictions.append({'country':country,'date':date_str,'error':"Date not available"})
+            else:
+                predictions.append({'country':country,'date':date_str,'yhat':float(values[0]),
+                                    'yhat_lower':float(values[1]),'yhat_upper':float(values[2])})
+
+    # update the log file
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    runtime = "%03d:%02d:%02d"%(h, m, s)
+    test=False
+    update_predict_log([p['yhat'] for p in predictions if 'yhat' in p],runtime,MODEL_VERSION,MODEL_VERSION_NOTE, test)
+    return predictions
+
 if __name__ == "__main__":
 
     """
@@ -2,4 +2,7 @@ import sys
 import unittest
 
 from unittests import *
-unittest.main()
+
+## guarded, since the worker-processes (started by a forkserver) import the main module
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,7 @@ import os
 import unittest
 import requests
 import re
+import time
 from ast import literal_eval
 import numpy as np
 
@@ -39,8 +40,19 @@ class ApiTest(unittest.TestCase):
       
         request_json = {'mode':'test'}
         r = requests.post('http://0.0.0.0:{}/train'.format(port),json=request_json)
-        train_complete = re.sub("\W+","",r.text)
-        self.assertEqual(train_complete,'true')
+        job_id = r.json()['job_id']
+
+        ## a second request joins the running job
+        r = requests.post('http://0.0.0.0:{}/train'.format(port),json=request_json)
+        self.assertEqual(r.json()['job_id'],job_id)
+
+        for _ in range(600):
+            r = requests.get('http://0.0.0.0:{}/train/{}'.format(port,job_id))
+            if r.json()['status'] in ['finished','failed']:
+                break
+            time.sleep(1)
+        self.assertEqual(r.json()['status'],'finished')
+        self.assertFalse(r.json()['warm_start'])
     
     @unittest.skipUnless(server_available,"local server is not running")
     def test_predict_empty(self):
@@ -73,6 +85,20 @@ class ApiTest(unittest.TestCase):
 
         r = requests.post('http://0.0.0.0:{}/predict'.format(port),json=query_data)
         self.assertTrue(r)
+    @unittest.skipUnless(server_available,"local server is not running")
+    def test_predict_batch(self):
+        """
+        test the batch predict functionality
+        """
+
+        query_data = {'queries': [{'country': "all", 'year': "2018", 'month': "12", 'day': "12"}],
+                      'ranges': [{'country': "all", 'start': "2018-12-01", 'end': "2018-12-31"}]}
+
+        r = requests.post('http://0.0.0.0:{}/predict_batch'.format(port),json=query_data)
+        result = r.json()
+        self.assertEqual(len(result),32)
+        self.assertEqual(result[0]['yhat'],result[12]['yhat'])
+
 ### Run the tests
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+cslib tests
+
+the reference implementations below are the original per-day loops
+they are kept here to check that the faster versions return the same data
+"""
+
+import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from cslib import fetch_data, convert_to_ts, convert_countries_to_ts, engineer_features
+from cslib import fetch_ts, load_ts, ts_countries, iter_data, _write_store
+
+DATA_DIR = os.path.join("cs_train")
+PRODUCTION_DIR = os.path.join("cs_production")
+TS_FILE = os.path.join("data","cs_train","data","ts-all.csv")
+
+def fetch_data_reference(data_dir):
+    """
+    original fetch_data() that reads the files serially and formats dates and invoices per row
+    """
+
+    file_list = [os.path.join(data_dir,f) for f in sorted(os.listdir(data_dir)) if re.search("\.json",f)]
+    all_months = {}
+    for file_name in file_list:
+        df = pd.read_json(file_name)
+        df.rename(columns={'StreamID':'stream_id','TimesViewed':'times_viewed','total_price':'price'},inplace=True)
+        all_months[os.path.split(file_name)[-1]] = df
+
+    df = pd.concat(list(all_months.values()),sort=True)
+    years,months,days = df['year'].values,df['month'].values,df['day'].values 
+    dates = ["{}-{}-{}".format(years[i],str(months[i]).zfill(2),str(days[i]).zfill(2)) for i in range(df.shape[0])]
+    df['invoice_date'] = np.array(dates,dtype='datetime64[D]')
+    df['invoice'] = [re.sub("\D+","",i) for i in df['invoice'].values]
+
+    df.sort_values(by='invoice_date',inplace=True,kind='mergesort')
+    df.reset_index(drop=True,inplace=True)
+    return(df)
+
+def convert_to_ts_reference(df_orig, country=None):
+    """
+    original convert_to_ts() that scans the data once per day
+    """
+
+    if country:
+        mask = df_orig['country'] == country
+        df = df_orig[mask]
+    else:
+        df = df_orig
+
+    start_month = '{}-{}'.format(df['year'].values[0],str(df['month'].values[0]).zfill(2))
+    stop_month = '{}-{}'.format(df['year'].values[-1],str(df['month'].values[-1]).zfill(2))
+    df_dates = df['invoice_date'].values.astype('datetime64[D]')
+    days = np.arange(start_month,stop_month,dtype='datetime64[D]')
+
+    purchases = np.array([np.where(df_dates==day)[0].size for day in days])
+    invoices = [np.unique(df[df_dates==day]['invoice'].values).size for day in days]
+    streams = [np.unique(df[df_dates==day]['stream_id'].values).size for day in days]
+    views =  [df[df_dates==day]['times_viewed'].values.sum() for day in days]
+    revenue = [df[df_dates==day]['price'].values.sum() for day in days]
+    year_month = ["-".join(re.split("-",str(day))[:2]) for day in days]
+
+    return(pd.DataFrame({'date':days,
+                         'purchases':purchases,
+                         'unique_invoices':invoices,
+                         'unique_streams':streams,
+                         'total_views':views,
+                         'year_month':year_month,
+                         'revenue':revenue}))
+
+def engineer_features_reference(df, training=True, previous=[7, 14, 28, 70]):
+    """
+    original engineer_features() that scans all dates for every window of every day
+    """
+
+    dates = df['date'].to_numpy().copy()
+    dates = dates.astype('datetime64[D]')
+
+    eng_features = defaultdict(list)
+    y = np.zeros(dates.size)
+    for d,day in enumerate(dates):
+        for num in previous:
+            current = np.datetime64(day, 'D') 
+            prev = current - np.timedelta64(num, 'D')
+            mask = np.isin(dates, np.arange(prev,current,dtype='datetime64[D]'))
+            eng_features["previous_{}".format(num)].append(df[mask]['revenue'].sum())
+
+        plus_30 = current + np.timedelta64(30,'D')
+        mask = np.isin(dates, np.arange(current,plus_30,dtype='datetime64[D]'))
+        y[d] = df[mask]['revenue'].sum()
+
+        start_date = current - np.timedelta64(365,'D')
+        stop_date = plus_30 - np.timedelta64(365,'D')
+        mask = np.isin(dates, np.arange(start_date,stop_date,dtype='datetime64[D]'))
+        eng_features['previous_year'].append(df[mask]['revenue'].sum())
+
+        minus_30 = current - np.timedelta64(30,'D')
+        mask = np.isin(dates, np.arange(minus_30,current,dtype='datetime64[D]'))
+        eng_features['recent_invoices'].append(df[mask]['unique_invoices'].mean())
+        eng_features['recent_views'].append(df[mask]['total_views'].mean())
+
+    X = pd.DataFrame(eng_features)
+    X.fillna(0,inplace=True)
+    mask = X.sum(axis=1)>0
+    X = X[mask]
+    y = y[mask]
+    dates = dates[mask]
+    X.reset_index(drop=True, inplace=True)
+
+    if training == True:
+        mask = np.arange(X.shape[0]) < np.arange(X.shape[0])[-30]
+        X = X[mask]
+        y = y[mask]
+        dates = dates[mask]
+        X.reset_index(drop=True, inplace=True)
+
+    return(X,y,dates)
+
+def scale_invoices(df, factor):
+    """
+    repeat a month of invoices over 'factor' consecutive 30 day periods
+    """
+
+    copies = []
+    for i in range(factor):
+        df_copy = df.copy()
+        df_copy['invoice_date'] = df['invoice_date'].values.astype('datetime64[D]') + np.timedelta64(30*i,'D')
+        df_copy['invoice'] = df['invoice'] + "{:03d}".format(i)
+        copies.append(df_copy)
+
+    df_scaled = pd.concat(copies)
+    dates = pd.DatetimeIndex(df_scaled['invoice_date'])
+    df_scaled['year'],df_scaled['month'],df_scaled['day'] = dates.year,dates.month,dates.day
+    df_scaled.reset_index(drop=True,inplace=True)
+    return(df_scaled)
+
+class CslibTest(unittest.TestCase):
+    """
+    Test the time-series aggregation functionality
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.df = scale_invoices(fetch_data(DATA_DIR),4)
+
+    def test_convert_to_ts(self):
+        """
+        ensure the aggregated data matches the original implementation
+        """
+
+        expected = convert_to_ts_reference(self.df)
+        result = convert_to_ts(self.df)
+        self.assertTrue(result.shape[0] > 0)
+        pd.testing.assert_frame_equal(result,expected,check_exact=True)
+
+    def test_convert_countries_to_ts(self):
+        """
+        ensure the single pass over all countries matches the per country version
+        """
+
+        countries = list(self.df['country'].value_counts().index[:5])
+        result = convert_countries_to_ts(self.df,countries)
+        self.assertEqual(sorted(result.keys()),sorted(countries))
+        for country in countries:
+            pd.testing.assert_frame_equal(result[country],convert_to_ts_reference(self.df,country=country),
+                                          check_exact=True)
+
+    def test_fetch_data(self):
+        """
+        ensure the parallel loader gives the same data as the original serial one
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for source_dir in [DATA_DIR,PRODUCTION_DIR]:
+                for file_name in os.listdir(source_dir):
+                    shutil.copy(os.path.join(source_dir,file_name),tmp_dir)
+
+            expected = fetch_data_reference(tmp_dir)
+            for n_workers in [1,2]:
+                pd.testing.assert_frame_equal(fetch_data(tmp_dir,n_workers=n_workers),expected,check_exact=True)
+
+            chunks = list(iter_data(tmp_dir,n_workers=2))
+            self.assertEqual(len(chunks),2)
+            self.assertEqual(sum([chunk.shape[0] for chunk in chunks]),expected.shape[0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_country_not_found(self):
+        """
+        ensure unknown countries are rejected
+        """
+
+        self.assertRaises(Exception,convert_to_ts,self.df,"atlantis")
+        self.assertRaises(Exception,convert_countries_to_ts,self.df,["atlantis"])
+
+class FeatureTest(unittest.TestCase):
+    """
+    Test the feature engineering functionality
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.df = pd.read_csv(TS_FILE)
+
+    def check_features(self, result, expected):
+        X,y,dates = result
+        X_expected,y_expected,dates_expected = expected
+        self.assertEqual(list(X.columns),list(X_expected.columns))
+        pd.testing.assert_frame_equal(X,X_expected,check_exact=False,rtol=1e-9)
+        self.assertTrue(np.allclose(y,y_expected,rtol=1e-9))
+        self.assertTrue(np.array_equal(dates,dates_expected))
+
+    def test_engineer_features(self):
+        """
+        ensure the features match the original implementation
+        """
+
+        for training in [True,False]:
+            self.check_features(engineer_features(self.df,training=training),
+                                engineer_features_reference(self.df,training=training))
+
+    def test_engineer_features_windows(self):
+        """
+        ensure the look-back windows can be configured
+        """
+
+        previous = [3, 21, 35]
+        X,y,dates = engineer_features(self.df,previous=previous)
+        self.assertEqual(list(X.columns)[:3],["previous_3","previous_21","previous_35"])
+        self.check_features((X,y,dates),engineer_features_reference(self.df,previous=previous))
+
+    def test_engineer_features_gaps(self):
+        """
+        ensure missing days are handled like days without revenue
+        """
+
+        df = self.df.drop(index=np.arange(100,400,3)).reset_index(drop=True)
+        self.check_features(engineer_features(df),engineer_features_reference(df))
+
+class StoreTest(unittest.TestCase):
+    """
+    Test the time-series store used by fetch_ts
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir,"invoices")
+        self.ts_data_dir = os.path.join(self.tmp_dir,"ts")
+        os.mkdir(self.data_dir)
+        for source_dir in [DATA_DIR,PRODUCTION_DIR]:
+            for file_name in os.listdir(source_dir):
+                shutil.copy(os.path.join(source_dir,file_name),self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fetch_ts(self):
+        """
+        ensure the stored series are the same as the converted data
+        """
+
+        dfs = fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        df = fetch_data(self.data_dir)
+        countries = ts_countries(self.ts_data_dir)
+        self.assertEqual(countries[0],'all')
+        self.assertEqual(list(dfs.keys()),countries)
+        self.assertTrue(dfs['all'].shape[0] > 0)
+        pd.testing.assert_frame_equal(load_ts('all',self.ts_data_dir),convert_to_ts(df),check_exact=True)
+        pd.testing.assert_frame_equal(load_ts('eire',self.ts_data_dir),convert_to_ts(df,country='EIRE'),
+                                      check_exact=True)
+
+    def test_store_invalidation(self):
+        """
+        ensure the store is only rebuilt when the json content changes
+        """
+
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        with open(os.path.join(self.ts_data_dir,"manifest.json")) as f:
+            version = json.load(f)['version']
+
+        ## same content with a new modification time
+        file_name = os.path.join(self.data_dir,os.listdir(self.data_dir)[0])
+        os.utime(file_name,(0,0))
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        with open(os.path.join(self.ts_data_dir,"manifest.json")) as f:
+            self.assertEqual(json.load(f)['version'],version)
+
+        ## new content
+        shutil.move(file_name,self.tmp_dir)
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        with open(os.path.join(self.ts_data_dir,"manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertNotEqual(manifest['version'],version)
+        self.assertEqual(manifest['versions'],[version,manifest['version']])
+        self.assertTrue(os.path.isdir(os.path.join(self.ts_data_dir,version)))
+
+        ## the previous version is only removed by the next write
+        shutil.move(os.path.join(self.tmp_dir,os.path.basename(file_name)),self.data_dir)
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        self.assertFalse(os.path.isdir(os.path.join(self.ts_data_dir,version)))
+        self.assertEqual(len([d for d in os.listdir(self.ts_data_dir) if d.startswith("store-")]),2)
+
+    def test_concurrent_writes(self):
+        """
+        ensure writers at the same time each publish a complete store
+        """
+
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        with open(os.path.join(self.ts_data_dir,"manifest.json")) as f:
+            manifest = json.load(f)
+        df = load_ts('all',self.ts_data_dir,complete=True)
+        reuse = [key for key in manifest['series'] if key != 'all']
+
+        writers = [threading.Thread(target=_write_store,args=(self.ts_data_dir,{'all':df},manifest,reuse,True))
+                   for _ in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        with open(os.path.join(self.ts_data_dir,"manifest.json")) as f:
+            manifest = json.load(f)
+        for version in manifest['versions']:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.ts_data_dir,version))),sorted(manifest['series']))
+        self.assertEqual([f for f in os.listdir(self.ts_data_dir) if f.endswith(".tmp")],[])
+        pd.testing.assert_frame_equal(load_ts('all',self.ts_data_dir,complete=True),df)
+
+    def test_incremental(self):
+        """
+        ensure adding a month gives the same store as processing everything again
+        """
+
+        production_files = os.listdir(PRODUCTION_DIR)
+        for file_name in production_files:
+            os.remove(os.path.join(self.data_dir,file_name))
+        dfs = fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        self.assertEqual(dfs['all'].shape[0],0)
+
+        for file_name in production_files:
+            shutil.copy(os.path.join(PRODUCTION_DIR,file_name),self.data_dir)
+        dfs = fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+
+        full_ts_data_dir = os.path.join(self.tmp_dir,"ts_full")
+        dfs_full = fetch_ts(self.data_dir,ts_data_dir=full_ts_data_dir)
+        self.assertEqual(list(dfs.keys()),list(dfs_full.keys()))
+        self.assertTrue(dfs['all'].shape[0] > 0)
+        for key in dfs_full.keys():
+            pd.testing.assert_frame_equal(dfs[key],dfs_full[key],check_exact=True)
+            pd.testing.assert_frame_equal(load_ts(key,self.ts_data_dir,complete=True),
+                                          load_ts(key,full_ts_data_dir,complete=True),check_exact=True)
+
+    def test_incremental_overlap(self):
+        """
+        ensure invoices for days that are already stored trigger a rebuild
+        """
+
+        fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        file_name = os.listdir(DATA_DIR)[0]
+        shutil.copy(os.path.join(DATA_DIR,file_name),os.path.join(self.data_dir,"copy-"+file_name))
+        dfs = fetch_ts(self.data_dir,ts_data_dir=self.ts_data_dir)
+        df = fetch_data(self.data_dir)
+        pd.testing.assert_frame_equal(dfs['all'],convert_to_ts(df),check_exact=True)
+
+    def test_csv_cache(self):
+        """
+        ensure series cached as csv files by earlier versions are carried over
+        """
+
+        os.mkdir(self.ts_data_dir)
+        shutil.copy(TS_FILE,self.ts_data_dir)
+        dfs = fetch_ts(os.path.join(self.tmp_dir,"empty"),ts_data_dir=self.ts_data_dir)
+        self.assertEqual(list(dfs.keys()),['all'])
+        expected = pd.read_csv(TS_FILE)
+        self.assertEqual(list(dfs['all'].columns),list(expected.columns))
+        self.assertTrue(np.array_equal(dfs['all']['revenue'].values,expected['revenue'].values))
+        self.assertEqual(str(dfs['all']['date'].values[0])[:10],expected['date'].values[0])
+
+### Run the tests
+if __name__ == '__main__':
+    unittest.main()
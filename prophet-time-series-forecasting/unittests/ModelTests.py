@@ -2,7 +2,7 @@
 import os
 import sys
 import unittest
-from prophet_model import model_train, model_predict
+from prophet_model import model_train, model_predict, model_predict_batch, FORECAST_DIR, MODEL_DIR
 
 class ModelTest(unittest.TestCase):
     """
@@ -17,6 +17,10 @@ class ModelTest(unittest.TestCase):
         ## train the model
         val=model_train()
         self.assertTrue(val)
+
+        ## forecasts and models are swapped in whole, no temporary files are left
+        for directory in [FORECAST_DIR,MODEL_DIR]:
+            self.assertEqual([f for f in os.listdir(directory) if f.endswith(".tmp")],[])
        
     def test_predict(self):
         """
@@ -43,6 +47,39 @@ class ModelTest(unittest.TestCase):
         result = model_predict("all","2300","11","11")
         self.assertEqual(result,"Date not available")
 
+    def test_predict_batch(self):
+        """
+        Test that batch predictions match single predictions
+        """
+
+        queries = [{'country':'all','year':'2018','month':'11','day':'11'},
+                   {'country':'finland','year':'2018','month':'11','day':'11'}]
+        ranges = [{'country':'all','start':'2018-11-01','end':'2018-11-30'}]
+        result = model_predict_batch(queries=queries,ranges=ranges)
+
+        self.assertEqual(len(result),32)
+        self.assertEqual(result[0]['yhat'],model_predict("all","2018","11","11").yhat.values[0])
+        self.assertTrue('error' in result[1])
+        self.assertEqual(result[12]['date'],"2018-11-11")
+        self.assertEqual(result[12]['yhat'],result[0]['yhat'])
+
+    def test_predict_batch_errors(self):
+        """
+        Test that malformed dates and entries fail only their own entries in a batch
+        """
+
+        queries = [{'country':'all','year':'2018','month':'13','day':'11'},
+                   {'country':'all','year':'2018','month':'11','day':'11'},
+                   "all 2018-11-11",42]
+        ranges = [{'country':'all','start':'not a date','end':'2018-11-30'},['all','2018-11-01','2018-11-30']]
+        result = model_predict_batch(queries=queries,ranges=ranges)
+
+        self.assertEqual(len(result),6)
+        self.assertTrue('error' in result[0])
+        self.assertEqual(result[1]['yhat'],model_predict("all","2018","11","11").yhat.values[0])
+        for entry in result[2:]:
+            self.assertTrue('error' in entry)
+
 ### Run the tests
 if __name__ == '__main__':
     unittest.main()
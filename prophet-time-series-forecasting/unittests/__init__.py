@@ -33,4 +33,11 @@ ModelTestSuite = unittest.TestLoader().loadTestsFromTestCase(ModelTest)
 from LoggerTests import *
 LoggerTestSuite = unittest.TestLoader().loadTestsFromTestCase(LoggerTest)
 
-MainSuite = unittest.TestSuite([LoggerTestSuite,ApiTestSuite, ModelTestSuite])
+## cslib tests
+from CslibTests import *
+CslibTestSuite = unittest.TestLoader().loadTestsFromTestCase(CslibTest)
+FeatureTestSuite = unittest.TestLoader().loadTestsFromTestCase(FeatureTest)
+StoreTestSuite = unittest.TestLoader().loadTestsFromTestCase(StoreTest)
+
+MainSuite = unittest.TestSuite([LoggerTestSuite,ApiTestSuite, ModelTestSuite,
+                                CslibTestSuite, FeatureTestSuite, StoreTestSuite])